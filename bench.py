@@ -0,0 +1,337 @@
+"""
+Offline benchmarks for the full refresh pipeline.
+
+Each case runs refresh() (the same pipeline as main.py) in a fresh process, with:
+ - the MOCK provider, or the CoinGecko/IEX providers replaying responses from ./resources/bench
+ - an in-memory SQLite database
+ - a null Inky board, so the display output stage runs without the hardware
+
+Wall time, CPU time and peak RSS are reported for each stage, for each supported resolution and colour, and compared
+against a stored baseline so regressions stand out.
+
+    python bench.py                    # run, and compare against the baseline if there is one
+    python bench.py --save-baseline    # run, and store the results as the new baseline
+    python bench.py --logging          # what logging costs building, laying out and painting a frame, by level
+"""
+import argparse
+import json
+import logging
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import Future
+from datetime import datetime, timedelta
+from typing import Any, Dict, List
+
+from inkystock.config import Config
+from inkystock.db import Database
+from inkystock.paint import Pillow
+from inkystock.stocks.base import Point, Stock
+from inkystock.stocks.coingecko import CoinGecko
+from inkystock.stocks.iex import IEX
+from inkystock.stocks.mock import Mock
+from inkystock.trace import span, tracer
+
+from main import setup_logging, refresh, build_chart, render
+
+FIXTURES = "./resources/bench"
+RESOLUTIONS = [(212, 104), (250, 122)]
+COLORS = ['black', 'red', 'yellow']
+PROVIDERS = ['MOCK', 'CoinGecko', 'IEX']
+
+CONFIG_TEMPLATE = """
+[Main]
+currency = {currency}
+crypto = {crypto}
+stock = {stock}
+provider = {provider}
+database = sqlite://
+display_width_pixels = {width}
+display_height_pixels = {height}
+color = {color}
+loglevel = WARNING
+
+[Outputs]
+local = {directory}/out.png
+raw = {directory}/out.raw
+socket = {directory}/inkystock.sock
+sinks = inky, png
+
+[IEX]
+token = bench
+
+[CoinGecko]
+api_key = bench
+
+[Mascot]
+
+[Fonts]
+# Compiled into the temporary directory, rather than left behind in ./data
+atlas = {directory}/atlas
+
+[Schedule]
+lock = {directory}/inkystock.lock
+
+[Market]
+# Otherwise the IEX cases skip the refresh outside NYSE hours, and the timings depend on the time of day
+enabled = false
+
+[Profiling]
+directory = {directory}/profiles
+"""
+
+
+def fixture(name: str) -> str:
+    with open(os.path.join(FIXTURES, name)) as f:
+        return f.read()
+
+
+class NullBoard:
+    """
+    Stands in for the Inky board returned by inky.auto()
+    """
+
+    def __init__(self):
+        self.image = None
+
+    def set_image(self, image):
+        self.image = image
+
+    def show(self):
+        pass
+
+
+class ReplayCoinGeckoAPI:
+    """
+    Stands in for the pycoingecko client, answering with recorded responses.
+    """
+
+    def get_coins_list(self):
+        return [{"id": "bitcoin", "symbol": "btc", "name": "Bitcoin"}]
+
+    def get_price(self, ids, vs_currencies):
+        return json.loads(fixture("coingecko_simple_price.json"))
+
+    def get_coin_market_chart_range_by_id(self, id, vs_currency, from_timestamp, to_timestamp):
+        return json.loads(fixture("coingecko_market_chart_range.json"))
+
+
+class ReplayCoinGecko(CoinGecko):
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self.cg = ReplayCoinGeckoAPI()  # type: ignore
+
+
+class ReplayResponse:
+
+    def __init__(self, text: str):
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class ReplayIEX(IEX):
+
+    def get(self, path: str, params: Dict):  # type: ignore
+        if path.endswith("/quote/latestPrice"):
+            return ReplayResponse(fixture("iex_quote_latestPrice.txt"))
+        if path.endswith("/chart/1m"):
+            return ReplayResponse(fixture("iex_chart_1m.json"))
+        raise ValueError(f"No recorded response for {path}")
+
+
+def replay(config: Config) -> Stock:
+    if config.main.provider == 'IEX':
+        return ReplayIEX(config)
+    elif config.main.provider == 'CoinGecko':
+        return ReplayCoinGecko(config)
+    return Mock(config)
+
+
+def cases() -> List[str]:
+    return [f"{w}x{h}:{color}:{provider}" for w, h in RESOLUTIONS for color in COLORS for provider in PROVIDERS]
+
+
+def run_case(case: str) -> Dict[str, Dict[str, float]]:
+    """
+    Run a single case in this process, returning the totals for each stage.
+    """
+    resolution, color, provider = case.split(":")
+    width, height = resolution.split("x")
+    setup_logging("WARNING")
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.ini")
+        with open(path, "w") as f:
+            f.write(CONFIG_TEMPLATE.format(
+                # IEX prices are in USD; sticking with it avoids a currency conversion (and a network call)
+                currency="USD" if provider == "IEX" else "EUR",
+                crypto="" if provider == "IEX" else "BTC",
+                stock="AAPL" if provider == "IEX" else "",
+                provider=provider, width=width, height=height, color=color, directory=directory))
+
+        tracer.reset()
+        with span("run"):
+            with span("config"):
+                config = Config(path=path)
+
+            with span("db.connect"):
+                db = Database(config)
+            # The ticker bar shows the recent prices, so give it some history to work with
+            for minutes in range(45, 0, -5):
+                db.store_current(Point(timestamp=datetime.now() - timedelta(minutes=minutes), data=100 + minutes))
+
+            refresh(config, db=db, stocks=replay(config), painter=Pillow(config, board=NullBoard()))
+
+    return tracer.stages()
+
+
+def logging_overhead(frames: int, turn: int = 10) -> Dict[str, Dict[str, float]]:
+    """
+    Seconds per frame to build, lay out and paint the UI (everything but the chart, which is built once) with logging
+    switched off entirely, and at each level. Nothing is written anywhere, so this is the cost of the log calls alone.
+
+    The levels take turns, `turn` frames at a time and in a different order each round, so warm-up and drift (other
+    processes, the CPU clocking down) are shared out between them rather than landing on whichever runs first.
+    :return: the min and median seconds per frame, by level
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.ini")
+        with open(path, "w") as f:
+            f.write(CONFIG_TEMPLATE.format(currency="EUR", crypto="BTC", stock="", provider="MOCK", width=250,
+                                           height=122, color="black", directory=directory))
+        config = Config(path=path)
+
+        stocks = Mock(config)
+        current, historical = stocks.current(), stocks.historical()
+        painter = Pillow(config, board=NullBoard())
+        chart: "Future" = Future()
+        chart.set_result(build_chart(config, painter, historical))
+
+        log = logging.getLogger("inkystock")
+        log.handlers = [logging.NullHandler()]
+        log.propagate = False
+
+        # Warm up the caches (fonts, atlases, sprites) first
+        for _ in range(5):
+            render(config, painter, current, historical, historical, chart=chart)
+
+        levels = ["off", "WARNING", "INFO", "DEBUG"]
+        timings: Dict[str, List[float]] = {level: [] for level in levels}
+        for rounds in range(max(1, frames // turn)):
+            shift = rounds % len(levels)
+            for level in levels[shift:] + levels[:shift]:
+                logging.disable(logging.CRITICAL if level == "off" else logging.NOTSET)
+                if level != "off":
+                    log.setLevel(getattr(logging, level))
+                for _ in range(turn):
+                    started = time.perf_counter()
+                    render(config, painter, current, historical, historical, chart=chart)
+                    timings[level].append(time.perf_counter() - started)
+        logging.disable(logging.NOTSET)
+
+    return {level: {"min": min(t), "median": statistics.median(t)} for level, t in timings.items()}
+
+
+def measure(case: str, repeat: int) -> Dict[str, Dict[str, float]]:
+    """
+    Run a case in fresh processes (so peak RSS and caches aren't shared between cases), taking the median.
+    """
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, __file__, "--case", case], check=True, capture_output=True, text=True)
+        runs.append(json.loads(out.stdout.splitlines()[-1]))
+
+    results = {}
+    for stage in runs[0]:
+        results[stage] = {
+            "seconds": statistics.median(r[stage]["seconds"] for r in runs if stage in r),
+            "cpu": statistics.median(r[stage]["cpu"] for r in runs if stage in r),
+            "rss": max(r[stage]["rss"] for r in runs if stage in r),
+        }
+    return results
+
+
+def compare(case: str, results: Dict[str, Dict[str, float]], baseline: Dict[str, Any],
+            tolerance: float, floor: float) -> List[str]:
+    """
+    A stage has regressed if it's slower than the baseline by more than the tolerance (as a fraction), ignoring
+    differences smaller than the floor (in seconds), which are just noise.
+    """
+    regressions = []
+    for stage, result in results.items():
+        before = baseline.get(case, {}).get(stage)
+        if not before:
+            continue
+        slower = result["seconds"] - before["seconds"]
+        if slower > floor and result["seconds"] > before["seconds"] * (1 + tolerance):
+            regressions.append(f"{case} {stage}: {before['seconds'] * 1000:.1f}ms -> {result['seconds'] * 1000:.1f}ms")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--case", help=f"run a single case, one of: {', '.join(cases())}")
+    parser.add_argument("--only", default="", help="only run cases containing this string, e.g. 250x122 or IEX")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline", default="./data/bench-baseline.json")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--floor", type=float, default=0.005)
+    parser.add_argument("--stages", action="store_true", help="show every stage, not just the totals")
+    parser.add_argument("--logging", action="store_true", help="measure the cost of logging, at each level")
+    args = parser.parse_args()
+
+    if args.case:
+        print(json.dumps(run_case(args.case)))
+        return
+
+    if args.logging:
+        overhead = logging_overhead(frames=200)
+        # Compared by the min, the run least disturbed by anything else; the median shows how noisy it was
+        print(f"{'logging':<10} {'min ms':>9} {'median ms':>10} {'overhead':>9}")
+        for level, seconds in overhead.items():
+            extra = (seconds["min"] - overhead["off"]["min"]) / overhead["off"]["min"] * 100
+            print(f"{level:<10} {seconds['min'] * 1000:>9.2f} {seconds['median'] * 1000:>10.2f} {extra:>+8.1f}%")
+        return
+
+    baseline: Dict[str, Any] = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    all_results = {}
+    regressions = []
+    print(f"{'case':<28} {'stage':<24} {'wall ms':>9} {'cpu ms':>9} {'rss MiB':>8} {'baseline':>9}")
+    for case in cases():
+        if args.only not in case:
+            continue
+        results = measure(case, args.repeat)
+        all_results[case] = results
+        for stage, result in results.items():
+            if not args.stages and stage != "run":
+                continue
+            before = baseline.get(case, {}).get(stage, {}).get("seconds")
+            before_ms = f"{before * 1000:.1f}" if before else "-"
+            print(f"{case:<28} {stage:<24} {result['seconds'] * 1000:>9.1f} {result['cpu'] * 1000:>9.1f} "
+                  f"{result['rss'] / 1024:>8.1f} {before_ms:>9}")
+        regressions += compare(case, results, baseline, args.tolerance, args.floor)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(all_results, f, indent=1)
+        print(f"Saved baseline to {args.baseline}")
+    elif regressions:
+        print("\nRegressions:")
+        for regression in regressions:
+            print(f"  {regression}")
+        raise SystemExit(1)
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,43 @@
+"""
+Cache server: one machine calls the providers for a fleet of displays on the same network (see stocks/relay.py).
+
+Give it a config for each upstream provider it should call (with its API keys). Its host, port and how long answers are
+kept come from [Relay] in the first one. Displays then use provider = Relay, with [Relay] url pointing here.
+
+The server is the one paying for the calls, so they're kept within each upstream's rate limits and monthly credits
+([Quota]), with the quota kept in that config's [Main] database.
+
+    python cache_server.py coingecko.ini iex.ini
+"""
+import argparse
+import logging
+
+from inkystock.config import Config
+from inkystock.stocks.relay import CacheServer, PriceCache
+
+from main import ENV_VARS, setup_logging, provider
+
+log = logging.getLogger("inkystock")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configs", nargs="+", help="a config.ini per upstream provider")
+    parser.add_argument("--loglevel", default="INFO")
+    args = parser.parse_args()
+
+    setup_logging(args.loglevel)
+
+    configs = [Config(env_vars=ENV_VARS, path=path, snapshot=True) for path in args.configs]
+    settings = configs[0].relay
+    server = CacheServer(PriceCache(configs, provider), settings.host, settings.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,183 @@
+"""
+Carousel: cycle one display through several pages (assets, or the same asset over different time ranges).
+
+    python carousel.py --config config.ini
+
+Every [Schedule] interval, the data for all the pages is fetched in one go and each page is rendered, once, into the
+page cache. Pages showing the same asset (e.g., BTC and BTC:intraday) share one call to the provider and one stored
+price. Every [Carousel] flip_interval, the next page's frame goes to the outputs as it is: flipping pages doesn't
+lay anything out or render anything again.
+"""
+import argparse
+import copy
+import logging
+import signal
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image as PILImage
+
+from inkystock.config import Config
+from inkystock.db import Database
+from inkystock.outputs import Outputs
+from inkystock.paint import Pillow, PillowImage
+from inkystock.stocks.base import Stock
+from inkystock.stocks.fetch import Fetch
+from inkystock.stocks.scheduler import Scheduled
+from inkystock.trace import span, tracer
+
+from main import (ENV_VARS, setup_logging, provider, fetch_key, historical_data, current_data, revalidate, chart_data,
+                  render)
+
+log = logging.getLogger("inkystock")
+
+
+def page_config(config: Config, page: str) -> Config:
+    """
+    The display's configuration, for a page: an asset (crypto or stock, whichever the display uses), optionally
+    followed by the chart mode, e.g. ETH:intraday
+    """
+    asset, _, mode = page.partition(":")
+    config = copy.copy(config)
+    if len(config.main.crypto):
+        config.main = config.main.copy(update={'crypto': asset.strip()})
+    else:
+        config.main = config.main.copy(update={'stock': asset.strip()})
+    if mode:
+        config.chart = config.chart.copy(update={'mode': mode.strip()})
+    return config
+
+
+class Page:
+
+    def __init__(self, config: Config, name: str, db: Database, stocks: Stock):
+        """
+        :param db: shared by the pages showing the same asset, as is the provider
+        """
+        self.name = name
+        self.config = config
+        self.db = db
+        self.stocks = stocks
+        # The rendered frame, ready for the outputs
+        self.frame: Optional[PILImage.Image] = None
+
+    def __repr__(self):
+        return f"(Page name={self.name}, rendered={self.frame is not None})"
+
+
+class Carousel:
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.painter = Pillow(config)
+        self.outputs = Outputs(config, self.painter)
+        pages = config.carousel.pages or [config.main.crypto or config.main.stock]
+        self.pages: List[Page] = []
+        # The pages for each asset, which get their data from the provider together (see main.fetch_key)
+        self.groups: Dict[Tuple[str, ...], List[Page]] = {}
+        for name in pages:
+            page_cfg = page_config(config, name)
+            key = fetch_key(page_cfg)
+            group = self.groups.get(key)
+            if group is None:
+                db = Database(page_cfg)
+                group = self.groups[key] = []
+                page = Page(page_cfg, name, db, Scheduled(page_cfg, db, provider(page_cfg)))
+            else:
+                page = Page(page_cfg, name, group[0].db, group[0].stocks)
+            group.append(page)
+            self.pages.append(page)
+        self.showing = -1
+
+    def __repr__(self):
+        return f"(Carousel pages={self.pages}, showing={self.showing})"
+
+    def update(self):
+        """
+        Fetch the data for every page, and render each of them into the page cache.
+        """
+        tracer.reset()
+        with span("run"):
+            pending: List[Tuple[Page, Fetch]] = []
+            for group in self.groups.values():
+                first = group[0]
+                try:
+                    # Once for the asset, however many pages show it
+                    with span(f"fetch.{first.name}"):
+                        historical = historical_data(first.db, first.stocks)
+                        current, stale, late = current_data(first.config, first.db, first.stocks)
+                        recent = first.db.recent()
+                    if late is not None:
+                        pending.append((first, late))
+                except Exception as e:
+                    # The pages keep their last frames (if they have them) until the next update
+                    log.exception(f"Couldn't update {[page.name for page in group]}: {e}")
+                    continue
+
+                for page in group:
+                    try:
+                        with span(f"page.{page.name}"):
+                            image = render(page.config, self.painter, current, historical, recent,
+                                           plotted=chart_data(page.config, page.db, historical), stale=stale)
+                            page.frame = image.render().copy()
+                    except Exception as e:
+                        log.exception(f"Couldn't update {page}: {e}")
+
+            # Any slow answers have had the whole batch to turn up
+            for page, late in pending:
+                revalidate(page.config, page.db, page.stocks, late)
+
+        log.info(f"Updated {len(self.pages)} pages; timings: {tracer.summary()}")
+        tracer.export(self.config.metrics.json_path, self.config.metrics.prometheus)
+
+    def flip(self):
+        """
+        Show the next page that's been rendered.
+        """
+        for _ in range(len(self.pages)):
+            self.showing = (self.showing + 1) % len(self.pages)
+            page = self.pages[self.showing]
+            if page.frame is not None:
+                log.debug(f"Showing {page}")
+                self.outputs.publish(PillowImage(page.frame))
+                return
+
+    def run(self):
+        updated = flipped = -float("inf")
+        while True:
+            now = time.monotonic()
+            if now - updated >= self.config.schedule.interval:
+                self.update()
+                updated = now
+            if now - flipped >= self.config.carousel.flip_interval:
+                self.flip()
+                flipped = now
+            wait = min(updated + self.config.schedule.interval, flipped + self.config.carousel.flip_interval)
+            time.sleep(max(0.0, wait - time.monotonic()))
+
+    def close(self):
+        self.outputs.close(self.config.fetch.timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.ini")
+    args = parser.parse_args()
+
+    config = Config(env_vars=ENV_VARS, path=args.config, snapshot=True)
+    setup_logging(config.main.loglevel)
+
+    carousel = Carousel(config)
+    # Stopped by systemd (or similar): let the panel finish what it's doing
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        carousel.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        carousel.close()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,114 @@
+"""
+Render farm: generate frames for many displays (one config.ini each) in a single process.
+
+Running main.py once per config repeats every import, font load and provider call. Here, configs that ask a provider for
+the same asset and currency share one fetch, and frames are rendered in parallel by a process pool, with each process
+reusing its font and sprite caches across frames. Each frame is written to the outputs of its own config.
+
+    python farm.py displays/*.ini
+"""
+import argparse
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from inkystock.config import Config
+from inkystock.db import Database
+from inkystock.outputs import Outputs
+from inkystock.paint import Pillow
+from inkystock.stocks.base import Point, Series
+from inkystock.stocks.scheduler import QuotaExceeded, Scheduled
+
+from main import ENV_VARS, setup_logging, provider, fetch_key, historical_data, chart_data, render
+
+log = logging.getLogger("inkystock")
+
+
+def render_frame(config: Config, current: Point, historical: Series, recent: Series, plotted: Series) -> str:
+    """
+    Runs in a worker process. Fonts and sprites are cached per process, so they're only loaded once per worker.
+    """
+    painter = Pillow(config)
+    image = render(config, painter, current, historical, recent, plotted=plotted)
+    outputs = Outputs(config, painter)
+    outputs.publish(image)
+    outputs.close()
+    return f"{outputs}"
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configs", nargs="+", metavar="config")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--loglevel", default="INFO")
+    args = parser.parse_args()
+
+    setup_logging(args.loglevel)
+
+    configs = [(path, Config(env_vars=ENV_VARS, path=path, snapshot=True)) for path in args.configs]
+
+    # One provider call per distinct (provider, asset, currency) rather than per config
+    groups: Dict[Tuple[str, ...], List[Tuple[str, Config]]] = {}
+    for path, config in configs:
+        groups.setdefault(fetch_key(config), []).append((path, config))
+    log.info(f"{len(configs)} configs share {len(groups)} distinct provider fetches")
+
+    jobs = []
+    # Frames that weren't rendered, since their group's data couldn't be pulled
+    skipped = 0
+    for key, members in groups.items():
+        try:
+            _, first = members[0]
+            first_db = Database(first)
+            stocks = Scheduled(first, first_db, provider(first))
+            log.info(f"Pulling current data from API for {key[:4]}")
+            try:
+                fetched: Optional[Point] = stocks.current()
+            except QuotaExceeded as e:
+                log.warning(f"{e}, showing the last stored price")
+                fetched = None
+
+            # The historical cache is per database, so only a miss in the first one goes to the provider. The result
+            # is stored in each of the other databases so single runs (main.py) against them also hit the cache.
+            historical = historical_data(first_db, stocks)
+
+            stored = set()
+            group = []
+            for path, config in members:
+                db = Database(config)
+                current = fetched if fetched is not None else db.latest()
+                # Configs pointing at the same database only need the price stored once
+                if config.main.database not in stored:
+                    if fetched is not None:
+                        db.store_current(fetched)
+                    if stocks.CACHE_HISTORICAL and config.main.database != first.main.database:
+                        try:
+                            db.retrieve_historical()
+                        except LookupError:
+                            db.store_historical(historical)
+                    stored.add(config.main.database)
+                group.append((path, config, current, historical, db.recent(), chart_data(config, db, historical)))
+            jobs += group
+        except Exception as e:
+            # One provider (or database) having a bad day shouldn't stop the rest of the farm
+            log.exception(f"Skipping the {len(members)} configs for {key[:4]}: {e}")
+            skipped += len(members)
+
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        futures = [(path, pool.submit(render_frame, config, current, historical, recent, plotted))
+                   for path, config, current, historical, recent, plotted in jobs]
+        failures = skipped
+        for path, future in futures:
+            try:
+                log.info(f"Rendered {path} to {future.result()}")
+            except Exception as e:
+                failures += 1
+                log.error(f"Failed to render {path}: {e}")
+
+    if failures:
+        raise SystemExit(f"{failures} of {len(configs)} frames failed to render")
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,217 @@
+"""
+Glyph atlases for the bundled pixel fonts.
+
+The fonts in resources/fonts are pixel fonts: every glyph is a fixed bitmap, however many times it's drawn. Drawing
+text through FreeType anyway (hinting, rasterizing, laying out) is most of the cost of painting the display. So each
+(font, size) is rasterized once, glyph by glyph, into a 1-bit atlas with each glyph's metrics, and text is drawn by
+pasting glyphs from the atlas.
+
+Atlases are kept on disk ([Fonts] atlas in config.ini), as a PNG of the glyphs with their metrics in a text chunk, so
+they're only compiled once (or ahead of time, with `python main.py --atlas`). Before an atlas is used, it's checked
+against FreeType drawing the same text, pixel for pixel. Fonts that don't lay out exactly glyph by glyph (e.g., with
+kerning, or fractional advances at a size the font wasn't designed for) fail the check and keep being drawn by FreeType,
+as does any text with characters outside the atlas.
+"""
+import hashlib
+import json
+import logging
+import os
+import string
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+import PIL
+from PIL import ImageFont as PILFont, Image as PILImage, ImageDraw as PILDraw
+from PIL.PngImagePlugin import PngInfo
+
+from inkystock.config import Config
+from inkystock.trace import traced
+
+log = logging.getLogger("inkystock")
+
+# Printable ASCII, plus the currency symbols prices might be shown in
+CHARSET = string.digits + string.ascii_letters + string.punctuation + " " + "€£¥₿"
+# Text the atlas has to draw exactly as FreeType does before it's used
+PROBES = [CHARSET, "0123456789", "+1.23%", "-45.6%", "12,345.67", "BTC EUR", "AAPL USD", "$ € £ ¥ ₿", "w"]
+# Bumped whenever the atlas format changes, so older atlases on disk are compiled again
+VERSION = 1
+
+# (x in the sheet, width, height) of a glyph's cell, and its bounding box when drawn at the origin
+Cell = Tuple[int, int, int]
+Box = Tuple[int, int, int, int]
+
+
+def rasterize(ttf: PILFont.FreeTypeFont, text: str) -> PILImage.Image:
+    """
+    Text drawn by FreeType, as a 1-bit mask sized the way Pillow.text always has.
+    """
+    bbox = ttf.getbbox(text)
+    # have to ignore bbox[1] because it produces cropped text
+    mask = PILImage.new('1', (bbox[2] - bbox[0], bbox[3]), 0)
+    draw = PILDraw.Draw(mask)
+    # Pixel fonts look awful antialiased (and the panels can't show it anyway)
+    draw.fontmode = "1"
+    draw.text((0, 0), text, 1, font=ttf)
+    return mask
+
+
+class Atlas:
+
+    def __init__(self, sheet: PILImage.Image, cells: Dict[str, Cell], boxes: Dict[str, Box],
+                 advances: Dict[str, int], exact: bool = False):
+        self.sheet = sheet
+        self.boxes = boxes
+        self.advances = advances
+        self.exact = exact
+        # Cut out once, so drawing is just pasting
+        self.glyphs = {ch: sheet.crop((x, 0, x + w, h)) for ch, (x, w, h) in cells.items() if w and h}
+        self._cells = cells
+
+    def __repr__(self):
+        return f"(Atlas glyphs={len(self.advances)}, size={self.sheet.size}, exact={self.exact})"
+
+    @classmethod
+    def compile(cls, ttf: PILFont.FreeTypeFont, charset: str = CHARSET) -> "Atlas":
+        """
+        Rasterize each glyph with FreeType, then check the atlas draws the probes exactly as FreeType does.
+        """
+        glyphs: Dict[str, PILImage.Image] = {}
+        boxes: Dict[str, Box] = {}
+        advances: Dict[str, int] = {}
+        for ch in charset:
+            length = ttf.getlength(ch)
+            box = ttf.getbbox(ch)
+            boxes[ch] = box  # type: ignore
+            # Fractional advances can't be drawn a glyph at a time
+            advances[ch] = int(length) if length == int(length) else -1
+            mask = PILImage.new('1', (max(box[2], 1), max(box[3], 1)), 0)
+            draw = PILDraw.Draw(mask)
+            draw.fontmode = "1"
+            draw.text((0, 0), ch, 1, font=ttf)
+            glyphs[ch] = mask.crop((max(box[0], 0), max(box[1], 0), box[2], box[3]))
+
+        cells: Dict[str, Cell] = {}
+        x = 0
+        for ch, glyph in glyphs.items():
+            cells[ch] = (x, glyph.width, glyph.height)
+            x += glyph.width
+        sheet = PILImage.new('1', (max(x, 1), max([g.height for g in glyphs.values()] + [1])), 0)
+        for ch, glyph in glyphs.items():
+            sheet.paste(glyph, (cells[ch][0], 0))
+
+        atlas = cls(sheet, cells, boxes, advances)
+        atlas.exact = all(v >= 0 for v in advances.values()) and all(atlas.matches(ttf, probe) for probe in PROBES)
+        return atlas
+
+    def matches(self, ttf: PILFont.FreeTypeFont, text: str) -> bool:
+        expected = rasterize(ttf, text)
+        drawn = self.compose(text)
+        if expected.size != drawn.size or expected.tobytes() != drawn.tobytes():
+            log.debug(f"Glyph atlas doesn't match FreeType for '{text}': {drawn.size} vs {expected.size}")
+            return False
+        return True
+
+    def covers(self, text: str) -> bool:
+        return all(ch in self.advances for ch in text)
+
+    def bbox(self, text: str) -> Box:
+        if not text:
+            return (0, 0, 0, 0)
+        x0 = y0 = x1 = y1 = None
+        pen = 0
+        for ch in text:
+            left, top, right, bottom = self.boxes[ch]
+            x0 = pen + left if x0 is None else min(x0, pen + left)
+            x1 = pen + right if x1 is None else max(x1, pen + right)
+            y0 = top if y0 is None else min(y0, top)
+            y1 = bottom if y1 is None else max(y1, bottom)
+            pen += self.advances[ch]
+        return (x0, y0, x1, y1)  # type: ignore
+
+    def compose(self, text: str) -> PILImage.Image:
+        """
+        Text drawn from the atlas, as a 1-bit mask the same size as rasterize() would make.
+        """
+        bbox = self.bbox(text)
+        mask = PILImage.new('1', (bbox[2] - bbox[0], bbox[3]), 0)
+        pen = 0
+        for ch in text:
+            glyph = self.glyphs.get(ch)
+            if glyph is not None:
+                left, top, _, _ = self.boxes[ch]
+                mask.paste(1, (pen + max(left, 0), max(top, 0)), mask=glyph)
+            pen += self.advances[ch]
+        return mask
+
+    def save(self, path: str):
+        metrics = {'cells': self._cells, 'boxes': self.boxes, 'advances': self.advances, 'exact': self.exact}
+        info = PngInfo()
+        info.add_text("metrics", json.dumps(metrics))
+        # Written in full before it replaces anything, as other processes might be loading it
+        partial = f"{path}.{os.getpid()}.tmp"
+        self.sheet.save(partial, format="PNG", pnginfo=info)
+        os.replace(partial, path)
+
+    @classmethod
+    def load(cls, path: str) -> "Atlas":
+        with PILImage.open(path) as sheet:
+            sheet.load()
+            metrics = json.loads(sheet.text["metrics"])  # type: ignore
+            return cls(sheet.convert('1'),
+                       {ch: tuple(cell) for ch, cell in metrics['cells'].items()},  # type: ignore
+                       {ch: tuple(box) for ch, box in metrics['boxes'].items()},  # type: ignore
+                       metrics['advances'], metrics['exact'])
+
+
+def atlas_path(directory: str, font: str, font_size: int) -> str:
+    """
+    Named for the font file's contents as well as its name, so an atlas is never used for a different font.
+    """
+    m = hashlib.sha1()
+    with open(font, 'rb') as f:
+        m.update(f.read())
+    m.update(f"{font_size}:{CHARSET}:{PIL.__version__}:{VERSION}".encode('utf-8'))
+    name = os.path.splitext(os.path.basename(font))[0]
+    return os.path.join(directory, f"{name}-{font_size}-{m.hexdigest()[:12]}.png")
+
+
+@lru_cache(maxsize=64)
+@traced("atlas")
+def atlas(font: str, font_size: int, directory: str = "") -> Optional[Atlas]:
+    """
+    The atlas for a font, loaded once per process: from the directory if it's been compiled already, otherwise
+    compiled (and saved there, if there's a directory).
+    :return: the atlas, or None if the font can't be drawn exactly from one
+    """
+    path = atlas_path(directory, font, font_size) if directory else None
+    glyphs = None
+    if path is not None and os.path.exists(path):
+        try:
+            glyphs = Atlas.load(path)
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f"Couldn't load the glyph atlas {path}, compiling it again: {e}")
+    if glyphs is None:
+        glyphs = Atlas.compile(PILFont.truetype(font, font_size))
+        log.info(f"Compiled the glyph atlas for {font} at {font_size}: {glyphs}")
+        if path is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                glyphs.save(path)
+            except OSError as e:
+                log.warning(f"Couldn't save the glyph atlas to {path}: {e}")
+    if not glyphs.exact:
+        log.debug(f"{font} at {font_size} doesn't draw exactly from a glyph atlas, using FreeType")
+        return None
+    return glyphs
+
+
+def compile_fonts(config: Config) -> List[Tuple[str, int, Optional[Atlas]]]:
+    """
+    Compile the atlases for the fonts drawn with Pillow ahead of time (the chart's are drawn by matplotlib).
+    """
+    fonts = config.fonts
+    if not fonts.atlas:
+        log.warning("No [Fonts] atlas directory configured, so there's nowhere to keep the atlases")
+    pairs = {(fonts.ticker, fonts.ticker_size), (fonts.symbol, fonts.symbol_size),
+             (fonts.statusbar, fonts.statusbar_size), (fonts.headline, fonts.headline_size)}
+    return [(font, size, atlas(font, size, fonts.atlas)) for font, size in sorted(pairs)]
@@ -0,0 +1,37 @@
+"""
+How long until the next refresh, going by how much the price has been moving.
+
+A fixed interval is a poor fit both ways: when BTC is moving 5% an hour, five minutes is a long time, and when the price
+is flat, every refresh is an API call, a write to the SD card and an e-ink refresh that shows nothing new. With
+[Schedule] adaptive, the interval shrinks towards min_interval as the price moves (high to low, over the last window
+minutes of stored prices), reaching it once the movement passes the threshold, and stretches out to max_interval when
+the price is flat.
+"""
+import logging
+
+from inkystock.config import Config
+from inkystock.db import Database
+
+log = logging.getLogger("inkystock")
+
+
+def adaptive_interval(movement: float, threshold: float, shortest: float, longest: float) -> float:
+    """
+    Scale the interval between longest (no movement) and shortest (movement at or past the threshold).
+    """
+    if threshold <= 0 or movement >= threshold:
+        return shortest
+    return longest - (longest - shortest) * movement / threshold
+
+
+def next_interval(config: Config, db: Database) -> float:
+    """
+    Seconds until the next refresh is due.
+    """
+    settings = config.schedule
+    if not settings.adaptive:
+        return settings.interval
+    movement = db.movement(settings.window)
+    interval = adaptive_interval(movement, settings.threshold, settings.min_interval, settings.max_interval)
+    log.info(f"Price moved {movement:.2%} in the last {settings.window} minutes, next refresh in {interval:.0f}s")
+    return interval
@@ -1,24 +1,160 @@
-import io
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from functools import lru_cache
 from math import sqrt
+from typing import List, Optional, Tuple
 
-import matplotlib.pyplot as plt
+import matplotlib
 from PIL import Image
 from matplotlib import font_manager, ticker
+from matplotlib.axes import Axes
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+try:
+    from matplotlib._tight_bbox import adjust_bbox
+except ImportError:  # matplotlib < 3.6
+    from matplotlib.tight_bbox import adjust_bbox  # type: ignore
 
 from inkystock.config import Config
 from inkystock.layout import Element
-from inkystock.stocks.base import Series
-from inkystock.paint import Palette
+from inkystock.stocks.base import Point, Series
+from inkystock.paint import Color, PaletteData
+from inkystock.trace import span
+
+# Pixel fonts look awful antialiased
+matplotlib.rcParams['text.antialiased'] = False
+
+# How many figures (one per geometry and font) to keep around for reuse
+FIGURE_CACHE_SIZE = 4
+
+# Each channel is thresholded to a bit (red=4, green=2, blue=1), giving one of the eight "corner" colours, which is
+# then mapped to the nearest palette index. The same mapping quantize() picks for those colours, except yellow: it's
+# as far from red as from white, and quantize() picked white, leaving the line off the chart on yellow panels.
+CHANNEL_LUT = [0] * 128 + [4] * 128 + [0] * 128 + [2] * 128 + [0] * 128 + [1] * 128
+BLACK_AND_WHITE_LUT = [Color.BLACK, Color.BLACK, Color.BLACK, Color.WHITE,
+                       Color.BLACK, Color.WHITE, Color.WHITE, Color.WHITE]
+# Red, magenta and yellow all become the panel's third colour, whether it's red or yellow
+COLOR_LUT = [Color.BLACK, Color.BLACK, Color.BLACK, Color.WHITE,
+             Color.ACCENT, Color.ACCENT, Color.ACCENT, Color.WHITE]
+
+
+@lru_cache(maxsize=16)
+def font_properties(path: str, size: float) -> font_manager.FontProperties:
+    return font_manager.FontProperties(fname=path, size=size)
+
+
+@dataclass
+class ChartFigure:
+    """
+    A matplotlib figure that's kept around and redrawn, rather than created for every chart.
+    Figures are created directly (not via pyplot), so nothing holds on to them once they drop out of the cache.
+    """
+    fig: Figure
+    ax: Axes
+    canvas: FigureCanvasAgg
+    # Charts sharing a figure take turns drawing on it
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+_figures: "OrderedDict[Tuple, ChartFigure]" = OrderedDict()
+_figures_lock = threading.Lock()
+
+
+def figure(figsize: Tuple[float, float], font: str, font_size: float) -> ChartFigure:
+    """
+    Fetch the figure for this geometry and font, creating it if needed.
+    """
+    key = (figsize, font, font_size)
+    with _figures_lock:
+        if key in _figures:
+            _figures.move_to_end(key)
+            return _figures[key]
+
+        fig = Figure(figsize=figsize)
+        canvas = FigureCanvasAgg(fig)
+        ax = fig.subplots()
+
+        # Configure font
+        ticks_font = font_properties(font, font_size)
+        for label in ax.get_yticklabels():
+            label.set_fontproperties(ticks_font)
+        for label in ax.get_xticklabels():
+            label.set_fontproperties(ticks_font)
+
+        # Set padding on axes to a low value
+        ax.yaxis.set_tick_params(pad=1, width=1)
+        ax.xaxis.set_tick_params(pad=1, width=1)
+
+        # Remove the right and top borders - "spines" - from the graph
+        ax.spines['right'].set_visible(False)
+        ax.spines['top'].set_visible(False)
+
+        _figures[key] = ChartFigure(fig=fig, ax=ax, canvas=canvas)
+        while len(_figures) > FIGURE_CACHE_SIZE:
+            _figures.popitem(last=False)
+        return _figures[key]
+
+
+def downsample(points: List[Point], threshold: int) -> List[Tuple[int, Point]]:
+    """
+    Reduce a series to at most `threshold` points with Largest-Triangle-Three-Buckets, which keeps the peaks and troughs
+    that a plain every-Nth-point pass would lose. Returns (position in the original series, point) pairs.
+    See https://skemman.is/bitstream/1946/15343/3/SS_MSthesis.pdf
+    """
+    n = len(points)
+    if threshold >= n or threshold < 3:
+        return list(enumerate(points))
+
+    # The first and last points are always kept, the rest are split into buckets and one point is picked from each
+    sampled = [(0, points[0])]
+    every = (n - 2) / (threshold - 2)
+    a = 0
+    for i in range(threshold - 2):
+        # The average of the next bucket is the third corner of the triangle
+        next_start = int((i + 1) * every) + 1
+        next_end = max(min(int((i + 2) * every) + 1, n), next_start + 1)
+        avg_x = (next_start + next_end - 1) / 2
+        avg_y = sum(p.data for p in points[next_start:next_end]) / (next_end - next_start)
+
+        # Pick the point in this bucket that makes the largest triangle with the last point picked
+        a_y = points[a].data
+        best, best_area = -1, -1.0
+        for j in range(int(i * every) + 1, next_start):
+            area = abs((a - avg_x) * (points[j].data - a_y) - (a - j) * (avg_y - a_y))
+            if area > best_area:
+                best, best_area = j, area
+        sampled.append((best, points[best]))
+        a = best
+
+    sampled.append((n - 1, points[-1]))
+    return sampled
+
+
+class ChartMode:
+    """
+    Where the chart's data comes from.
+    """
+    # Daily history from the provider
+    DAILY = "daily"
+    # The prices stored on each refresh (see Database.intraday)
+    INTRADAY = "intraday"
 
 
 class Chart(Element):
 
     TIMESTAMP_FORMAT = "%-d/%-m"
+    INTRADAY_TIMESTAMP_FORMAT = "%H:%M"
+    # Any more than this and the labels run into each other
+    MAX_LABELS = 7
 
-    def __init__(self, config: Config, width: int, height: int):
+    def __init__(self, config: Config, width: int, height: int, timestamp_format: str = TIMESTAMP_FORMAT):
         # Create Matplotlib pixel chart
         self.config = config
+        self.timestamp_format = timestamp_format
         self._cache = None
+        self._points: Optional[List[Tuple[int, Point]]] = None
 
         # Trying to approximate appropriate pixel values for feeding to figsize.
         # I haven't gone spelunking through pyplot, so it's just firing numbers into a magic box.
@@ -35,26 +171,13 @@ class Chart(Element):
             h_offset = 10
         w = width - w_offset
         h = height - h_offset
-        self.fig, self.ax = plt.subplots(figsize=(w*px, h*px))
-
-        # Configure font
-        ticks_font = font_manager.FontProperties(fname=self.config.fonts.chart, size=self.config.fonts.chart_size)
-        plt.rcParams['text.antialiased'] = False
-        for label in self.ax.get_yticklabels():
-            label.set_fontproperties(ticks_font)
-        for label in self.ax.get_xticklabels():
-            label.set_fontproperties(ticks_font)
-
-        # Set padding on axes to a low value
-        self.ax.yaxis.set_tick_params(pad=1, width=1)
-        self.ax.xaxis.set_tick_params(pad=1, width=1)
-
-        # Remove the right and top borders - "spines" - from the graph
-        self.ax.spines['right'].set_visible(False)
-        self.ax.spines['top'].set_visible(False)
+        # There's no point plotting more points than there are pixels across
+        self.pixels = w
+        self.figure = figure((w*px, h*px), self.config.fonts.chart, self.config.fonts.chart_size)
 
     def __repr__(self):
-        return f"(Chart size={self.size()}, dpi={self.dpi()})"
+        # Only the size it's been rendered at, if it has been: describing the chart shouldn't render it
+        return f"(Chart size={self._cache.size if self._cache else None}, dpi={self.dpi()})"
 
     def dpi(self) -> float:
         """
@@ -69,38 +192,86 @@ class Chart(Element):
         return self.render().size
 
     def plot(self, s: Series):
+        # The drawing happens at render time, since the figure may be shared with other charts.
+        # Long series (a year of prices, a day of 5 minute ticks) are downsampled first, so the cost of drawing doesn't
+        # depend on how much data there is.
         self._cache = None
-        x = []
-        y = []
-        if max(p.data for p in s.series) > 999:
+        self._points = downsample(s.series, self.pixels)
+
+    def _draw(self, points: Optional[List[Tuple[int, Point]]]):
+        """
+        Redraw the shared figure with this chart's data: only the line and the tick labels change.
+        """
+        ax = self.figure.ax
+        for line in list(ax.lines):
+            line.remove()
+        if not points:
+            return
+
+        if max(p.data for _, p in points) > 999:
             # Use 'K' to denominate thousands to stop the labels getting too large
-            self.ax.yaxis.set_major_formatter(ticker.FuncFormatter(lambda v, _: f"{int(v / 1000)}K"))
-        elif max(p.data for p in s.series) < 1:
+            ax.yaxis.set_major_formatter(ticker.FuncFormatter(lambda v, _: f"{int(v / 1000)}K"))
+        elif max(p.data for _, p in points) < 1:
             # Two decimal places and strip leading zeros when price is less than 1
-            self.ax.yaxis.set_major_formatter(ticker.FuncFormatter(lambda v, _: f"{v:.2f}".lstrip('0')))
+            ax.yaxis.set_major_formatter(ticker.FuncFormatter(lambda v, _: f"{v:.2f}".lstrip('0')))
+        else:
+            ax.yaxis.set_major_formatter(ticker.ScalarFormatter())
 
-        for p in s.series:
-            x.append(p.timestamp.strftime(self.TIMESTAMP_FORMAT))
-            y.append(p.data)
-        self.ax.plot(x, y,
-                     linewidth=1,
-                     linestyle='solid',
-                     solid_joinstyle='miter',
-                     color=self.config.main.color)
+        # Plotting against positions (in the original series) rather than the labels themselves, since matplotlib
+        # remembers every category it's seen on an axis, which doesn't work out when the axis is reused.
+        x = [i for i, _ in points]
+        y = [p.data for _, p in points]
+
+        # Label every point if there's room, otherwise spread the labels evenly
+        ticks = points
+        if len(points) > self.MAX_LABELS:
+            step = (len(points) - 1) / (self.MAX_LABELS - 1)
+            ticks = [points[round(i * step)] for i in range(self.MAX_LABELS)]
+        ax.set_xticks([i for i, _ in ticks])
+        ax.set_xticklabels([p.timestamp.strftime(self.timestamp_format) for _, p in ticks])
+        ax.plot(x, y,
+                linewidth=1,
+                linestyle='solid',
+                solid_joinstyle='miter',
+                color=self.config.main.color)
+        ax.relim()
+        ax.autoscale_view()
 
     def render(self):
         if self._cache:
             return self._cache
 
-        if self.config.main.color in ['red', 'yellow']:
-            palette = Palette.color()
-            num_colors = 3
-        else:
-            palette = Palette.black_and_white()
-            num_colors = 2
+        with span("chart.render"):
+            if self.config.main.color in ['red', 'yellow']:
+                palette, lut = PaletteData.COLOR, COLOR_LUT
+            else:
+                palette, lut = PaletteData.BLACK_AND_WHITE, BLACK_AND_WHITE_LUT
 
-        with io.BytesIO() as f:
-            self.fig.savefig(f, dpi=self.dpi(), pad_inches=0, bbox_inches='tight')
-            chart = Image.open(f).convert('RGB')
-            self._cache = chart.quantize(colors=num_colors, palette=palette, dither=Image.Dither.NONE)
+            with self.figure.lock:
+                self._draw(self._points)
+                chart = self.rasterize(lut)
+            chart.putpalette(palette)
+            self._cache = chart
             return self._cache
+
+    def rasterize(self, lut: List[int]) -> Image.Image:
+        """
+        Draw the figure cropped to the chart, exactly as savefig(bbox_inches='tight') does, and threshold the Agg buffer
+        to palette indexes. Unlike savefig(), there's no PNG to encode and decode again, and the layout is only worked
+        out once, while measuring the tight bounding box.
+        """
+        fig, canvas = self.figure.fig, self.figure.canvas
+        fig.set_dpi(self.dpi())
+        bbox = fig.get_tightbbox(canvas.get_renderer())
+        # Shifts and resizes the figure to the bounding box, by fractions of a pixel, so everything lands on the same
+        # pixels as it did with savefig()
+        restore = adjust_bbox(fig, bbox, canvas.get_renderer())
+        try:
+            canvas.draw()
+            # No copy: this is a view on the canvas' buffer, which is only valid until the next draw
+            buffer = Image.frombuffer('RGBA', canvas.get_width_height(), canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+            # Per channel bits, summed into 0-7, then looked up
+            bits = buffer.convert('RGB').point(CHANNEL_LUT).convert('L', matrix=(1, 1, 1, 0))
+        finally:
+            restore()
+        return bits.point(lut + [0] * (256 - len(lut)))
@@ -1,14 +1,29 @@
+import hashlib
+import json
 import os
 from configparser import ConfigParser
-from typing import List, Optional, Union
+from datetime import date, datetime
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple, Type, Union
 from pydantic import BaseModel, validator, HttpUrl
-from inky.auto import auto
 
 
 class ConfigurationException(ValueError):
     """Configuration Exception"""
 
 
+@lru_cache(maxsize=None)
+def detect_display() -> Tuple[Tuple[int, int], str]:
+    """
+    Probe the Inky board's EEPROM (over I2C) for its resolution and colour.
+    This is slow-ish, so only do it once, no matter how many settings are 'auto'.
+    """
+    # Imported here so that runs with a fixed (or snapshotted) resolution and colour don't pay for the import
+    from inky.auto import auto
+    display = auto()
+    return display.resolution, display.colour
+
+
 class MainConfig(BaseModel):
     currency = "EUR"
     database = "sqlite:////tmp/inkystock.db"
@@ -25,22 +40,22 @@ class MainConfig(BaseModel):
     @validator('display_width_pixels', pre=True, always=True)
     def auto_display_width(cls, v):
         if not v or v == 'auto':
-            display = auto()
-            return display.resolution[0]
+            resolution, _ = detect_display()
+            return resolution[0]
         return v
 
     @validator('display_height_pixels', pre=True, always=True)
     def auto_display_height(cls, v):
         if not v or v == 'auto':
-            display = auto()
-            return display.resolution[1]
+            resolution, _ = detect_display()
+            return resolution[1]
         return v
 
     @validator('color', pre=True, always=True)
     def auto_color(cls, v):
         if not v or v == 'auto':
-            display = auto()
-            return display.colour
+            _, colour = detect_display()
+            return colour
         return v
 
     @validator('currency')
@@ -82,6 +97,9 @@ class FontsConfig(BaseModel):
     headline_size: int = 30
     chart: str = "./resources/fonts/04B_03__.TTF"
     chart_size: float = 5.2
+    # Where the fonts' glyph atlases are compiled to, so text is drawn without FreeType (see inkystock/atlas.py).
+    # Empty to compile them in memory in each process instead.
+    atlas: str = "./data/atlas"
 
 
 class MascotConfig(BaseModel):
@@ -117,15 +135,322 @@ class CoinGecko(BaseModel):
 class OutputConfig(BaseModel):
     screen: str = "inky"
     local: str = "./data/out.png"
+    snapshot: str = "always"
+    snapshot_every: int = 1
+    snapshot_history: int = 5
+    snapshot_compress_level: int = 6
+    sinks: List[str] = []
+    raw: str = "./data/out.raw"
+    http_host: str = "127.0.0.1"
+    http_port: int = 8000
+    socket: str = "./data/inkystock.sock"
+
+    @validator('sinks', pre=True, always=True)
+    def valid_sinks(cls, v, values):
+        if isinstance(v, str):
+            v = [s.strip() for s in v.split(",") if s.strip()]
+        if not v:
+            # Not configured, so fall back to the original behaviour of a snapshot plus the screen
+            v = ['png']
+            if values.get('screen') == 'inky':
+                v.append('inky')
+        supported = ['inky', 'png', 'raw', 'http', 'socket']
+        for sink in v:
+            if sink not in supported:
+                raise ConfigurationException(f"sinks must be some of {supported}")
+        return v
+
+    @validator('snapshot')
+    def valid_snapshot(cls, v):
+        policies = ['always', 'changed', 'every', 'history']
+        if v not in policies:
+            raise ConfigurationException(f"snapshot must be one of {policies}")
+        return v
+
+    @validator('snapshot_every', 'snapshot_history')
+    def positive(cls, v):
+        if v < 1:
+            raise ConfigurationException("must be a positive integer")
+        return v
+
+    @validator('snapshot_compress_level')
+    def valid_compress_level(cls, v):
+        if not 0 <= v <= 9:
+            raise ConfigurationException("must be between 0 (uncompressed) and 9")
+        return v
+
+
+class ChartConfig(BaseModel):
+    mode: str = "daily"
+    hours: int = 24
+    bucket_minutes: int = 15
+
+    @validator('mode')
+    def valid_mode(cls, v):
+        modes = ['daily', 'intraday']
+        if v not in modes:
+            raise ConfigurationException(f"mode must be one of {modes}")
+        return v
+
+    @validator('hours', 'bucket_minutes')
+    def positive(cls, v):
+        if v < 1:
+            raise ConfigurationException("must be a positive integer")
+        return v
+
+
+class CarouselConfig(BaseModel):
+    # Pages for carousel.py to cycle through: an asset each (crypto or stock, as in [Main]), optionally followed by the
+    # chart mode, e.g. BTC, ETH, BTC:intraday
+    pages: List[str] = []
+    # Seconds each page is shown for
+    flip_interval: float = 60.0
+
+    @validator('pages', pre=True)
+    def valid_pages(cls, v):
+        if isinstance(v, str):
+            v = [s.strip() for s in v.split(",") if s.strip()]
+        for page in v:
+            asset, _, mode = page.partition(":")
+            if not asset.strip():
+                raise ConfigurationException(f"page '{page}' needs an asset")
+            if mode and mode.strip() not in ['daily', 'intraday']:
+                raise ConfigurationException(f"page '{page}' chart mode must be daily or intraday")
+        return v
+
+    @validator('flip_interval')
+    def positive(cls, v):
+        if v <= 0:
+            raise ConfigurationException("must be a positive number of seconds")
+        return v
+
+
+class FetchConfig(BaseModel):
+    # Seconds a refresh waits for the current price before showing the last stored one
+    budget: float = 5.0
+    # Seconds before any one request to the provider gives up
+    timeout: float = 30.0
+
+    @validator('budget', 'timeout')
+    def positive(cls, v):
+        if v <= 0:
+            raise ConfigurationException("must be a positive number of seconds")
+        return v
+
+
+class RelayConfig(BaseModel):
+    # For provider = Relay: the cache server to ask, and which provider it should ask
+    url: str = "http://127.0.0.1:8766"
+    upstream: str = "CoinGecko"
+    # For the cache server itself (cache_server.py): where it listens, and how long (seconds) it keeps answers
+    host: str = "127.0.0.1"
+    port: int = 8766
+    current_ttl: float = 60.0
+    historical_ttl: float = 3600.0
+
+    @validator('current_ttl', 'historical_ttl')
+    def not_negative(cls, v):
+        if v < 0:
+            raise ConfigurationException("must not be negative")
+        return v
+
+
+class RenderConfig(BaseModel):
+    # For the render server (render_server.py)
+    host: str = "127.0.0.1"
+    port: int = 8767
+    # Worker processes rendering frames, 0 for one per CPU
+    workers: int = 0
+    # Frames kept, for requests with the same data and geometry
+    cache_size: int = 64
+
+    @validator('workers')
+    def not_negative(cls, v):
+        if v < 0:
+            raise ConfigurationException("must not be negative")
+        return v
+
+    @validator('cache_size')
+    def positive(cls, v):
+        if v < 1:
+            raise ConfigurationException("must be a positive integer")
+        return v
+
+
+class QuotaConfig(BaseModel):
+    # Unset means the provider's own (free plan) limits, 0 means unlimited
+    calls_per_minute: Optional[float] = None
+    monthly_credits: Optional[int] = None
+    # How long a refresh will wait for the rate limit before giving up and showing cached data
+    max_wait: float = 10.0
+
+    @validator('calls_per_minute', 'monthly_credits', 'max_wait')
+    def not_negative(cls, v):
+        if v is not None and v < 0:
+            raise ConfigurationException("must not be negative")
+        return v
+
+
+class StreamConfig(BaseModel):
+    # A line-delimited JSON price feed (see stocks/stream.py)
+    host: str = "127.0.0.1"
+    port: int = 8765
+    # Redraw when the price has moved by this fraction since the last redraw (0.005 = 0.5%)
+    threshold: float = 0.005
+    # E-ink panels take a while to refresh, and don't like doing it constantly
+    min_redraw_interval: float = 60.0
+    # Store one price every sample_interval seconds, written to the database in a batch every flush_interval seconds
+    sample_interval: float = 60.0
+    flush_interval: float = 300.0
+
+    @validator('threshold', 'min_redraw_interval', 'sample_interval', 'flush_interval')
+    def not_negative(cls, v):
+        if v < 0:
+            raise ConfigurationException("must not be negative")
+        return v
+
+
+class ScheduleConfig(BaseModel):
+    # Seconds between refreshes when main.py runs with --loop (and how often cron runs it, otherwise)
+    interval: float = 300.0
+    # Held by the run in progress, so runs from cron don't overlap (see lock.py)
+    lock: str = "./data/inkystock.lock"
+    # What a run does when the last one is still going: 'coalesce' into one follow-up run, or 'skip'
+    overlap: str = "coalesce"
+    # Refresh more often when the price is moving, and less when it's flat (see cadence.py)
+    adaptive: bool = False
+    min_interval: float = 60.0
+    max_interval: float = 1800.0
+    # Movement (high to low, as a fraction of the price) over the last window minutes that gets the shortest interval
+    threshold: float = 0.01
+    window: int = 60
+
+    @validator('interval', 'min_interval', 'threshold', 'window')
+    def positive(cls, v):
+        if v <= 0:
+            raise ConfigurationException("must be a positive number")
+        return v
+
+    @validator('max_interval')
+    def valid_max_interval(cls, v, values):
+        if v < values.get('min_interval', 0):
+            raise ConfigurationException("max_interval must not be less than min_interval")
+        return v
+
+    @validator('overlap')
+    def valid_overlap(cls, v):
+        options = ['coalesce', 'skip']
+        if v not in options:
+            raise ConfigurationException(f"overlap must be one of {options}")
+        return v
+
+
+class MarketConfig(BaseModel):
+    # Skip refreshes while the exchange is closed. Unset means for stock providers (IEX), and not crypto.
+    enabled: Optional[bool] = None
+    timezone: str = "America/New_York"
+    # Times and dates are kept as strings (HH:MM, YYYY-MM-DD), since a restored snapshot isn't parsed again
+    open: str = "09:30"
+    close: str = "16:00"
+    days: List[str] = ['mon', 'tue', 'wed', 'thu', 'fri']
+    # Built-in holiday rules, 'nyse' or 'none'
+    holidays: str = "nyse"
+    # Other days the exchange is closed
+    closed: List[str] = []
+
+    @validator('days', 'closed', pre=True)
+    def split(cls, v):
+        if isinstance(v, str):
+            v = [s.strip() for s in v.split(",") if s.strip()]
+        return v
+
+    @validator('days')
+    def valid_days(cls, v):
+        days = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+        v = [d.lower()[:3] for d in v]
+        if not v or any(d not in days for d in v):
+            raise ConfigurationException(f"days must be some of {days}")
+        return v
+
+    @validator('open', 'close')
+    def valid_time(cls, v):
+        try:
+            return datetime.strptime(v.strip(), "%H:%M").strftime("%H:%M")
+        except ValueError:
+            raise ConfigurationException("must be a time, HH:MM")
+
+    @validator('close')
+    def valid_close(cls, v, values):
+        if 'open' in values and v <= values['open']:
+            raise ConfigurationException("close must be after open")
+        return v
+
+    @validator('closed', each_item=True)
+    def valid_closed(cls, v):
+        try:
+            return date.fromisoformat(v).isoformat()
+        except ValueError:
+            raise ConfigurationException("must be dates, YYYY-MM-DD")
+
+    @validator('holidays')
+    def valid_holidays(cls, v):
+        options = ['nyse', 'none']
+        if v not in options:
+            raise ConfigurationException(f"holidays must be one of {options}")
+        return v
+
+
+class MetricsConfig(BaseModel):
+    json_path: str = ""
+    prometheus: str = ""
+    # Path to write the laid out UI to, as a JSON tree, after each render (empty to skip)
+    layout_path: str = ""
+
+
+class ProfilingConfig(BaseModel):
+    enabled: bool = False
+    directory: str = "./data/profiles"
+    keep: int = 10
+    top: int = 25
+
+    @validator('keep', 'top')
+    def positive(cls, v):
+        if v < 1:
+            raise ConfigurationException("must be a positive integer")
+        return v
 
 
 class Config:
+    # Each configuration section, by the attribute it's available as. Used to save and restore snapshots.
+    SECTIONS: Dict[str, Type[BaseModel]] = {
+        'main': MainConfig,
+        'outputs': OutputConfig,
+        'fonts': FontsConfig,
+        'mascot': MascotConfig,
+        'chart': ChartConfig,
+        'carousel': CarouselConfig,
+        'iex': IEXConfig,
+        'coingecko': CoinGecko,
+        'relay': RelayConfig,
+        'render': RenderConfig,
+        'quota': QuotaConfig,
+        'fetch': FetchConfig,
+        'stream': StreamConfig,
+        'schedule': ScheduleConfig,
+        'market': MarketConfig,
+        'metrics': MetricsConfig,
+        'profiling': ProfilingConfig,
+    }
+    # Sections with API keys in them. Left out of snapshots, which would otherwise be a copy of the keys sitting next to
+    # the configuration file, so they're read from the configuration file (and environment) every time.
+    SECRETS = {'iex', 'coingecko'}
 
-    def __init__(self, env_vars: Optional[List] = None, path: str = 'config.ini'):
+    def __init__(self, env_vars: Optional[List] = None, path: str = 'config.ini', snapshot: bool = False):
         """
         Read configuration file and set map to Pydantic models.
         :param path: path to the configuration file
         :param: env: environment dictionary
+        :param snapshot: reuse (or save) the validated configuration from a snapshot alongside the configuration file
         :return: a Config object
         :rtype: Config
         """
@@ -140,13 +465,67 @@ class Config:
         self.__config = ConfigParser(env)
         self.__config.read(path)
 
+        snapshot_path = None
+        if snapshot:
+            snapshot_path = self.snapshot_path(path)
+            key = self.snapshot_key(path, env)
+            if self.load_snapshot(snapshot_path, key):
+                self.read_secrets()
+                return
+
         self.main = MainConfig(**self.__config['Main'])
         self.outputs = OutputConfig()
         if self.__config.has_section('Outputs'):
             self.outputs = OutputConfig(**self.__config['Outputs'])
         self.fonts = FontsConfig(**self.__config['Fonts'])
         self.mascot = MascotConfig(**self.__config['Mascot'])
+        self.chart = ChartConfig()
+        if self.__config.has_section('Chart'):
+            self.chart = ChartConfig(**self.__config['Chart'])
+        self.carousel = CarouselConfig()
+        if self.__config.has_section('Carousel'):
+            self.carousel = CarouselConfig(**self.__config['Carousel'])
+
+        self.metrics = MetricsConfig()
+        if self.__config.has_section('Metrics'):
+            self.metrics = MetricsConfig(**self.__config['Metrics'])
+        self.profiling = ProfilingConfig()
+        if self.__config.has_section('Profiling'):
+            self.profiling = ProfilingConfig(**self.__config['Profiling'])
+
+        self.read_secrets()
+
+        self.relay = RelayConfig()
+        if self.__config.has_section('Relay'):
+            self.relay = RelayConfig(**self.__config['Relay'])
+
+        self.render = RenderConfig()
+        if self.__config.has_section('Render'):
+            self.render = RenderConfig(**self.__config['Render'])
+
+        self.quota = QuotaConfig()
+        if self.__config.has_section('Quota'):
+            self.quota = QuotaConfig(**self.__config['Quota'])
+        self.fetch = FetchConfig()
+        if self.__config.has_section('Fetch'):
+            self.fetch = FetchConfig(**self.__config['Fetch'])
+        self.stream = StreamConfig()
+        if self.__config.has_section('Stream'):
+            self.stream = StreamConfig(**self.__config['Stream'])
+        self.schedule = ScheduleConfig()
+        if self.__config.has_section('Schedule'):
+            self.schedule = ScheduleConfig(**self.__config['Schedule'])
+        self.market = MarketConfig()
+        if self.__config.has_section('Market'):
+            self.market = MarketConfig(**self.__config['Market'])
+
+        if snapshot_path:
+            self.save_snapshot(snapshot_path, key)
 
+    def read_secrets(self):
+        """
+        The provider sections with API keys in them (see SECRETS).
+        """
         # IEXCloud provider configuration
         self.iex = IEXConfig(token="")
         if self.main.provider == 'IEX':
@@ -156,3 +535,59 @@ class Config:
         self.coingecko = CoinGecko(api_key="")
         if self.main.provider == 'CoinGecko':
             self.coingecko = CoinGecko(**self.__config['CoinGecko'])
+
+    @staticmethod
+    def snapshot_path(path: str) -> str:
+        directory, name = os.path.split(path)
+        return os.path.join(directory, f".{name}.snapshot.json")
+
+    @staticmethod
+    def snapshot_key(path: str, env: Dict[str, str]) -> str:
+        """
+        A snapshot is only valid for the exact same configuration file, environment and version of this module.
+        """
+        m = hashlib.sha1()
+        for p in [path, __file__]:
+            try:
+                with open(p, 'rb') as f:
+                    m.update(f.read())
+            except OSError:
+                pass
+        m.update(json.dumps(env, sort_keys=True).encode('utf-8'))
+        return m.hexdigest()
+
+    def load_snapshot(self, path: str, key: str) -> bool:
+        """
+        Restore previously validated (and hardware detected) configuration, skipping validation.
+        Note: auto-detected display settings are part of the snapshot, so it's worth deleting it if the display is
+        swapped for a different one.
+        """
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if snapshot.get('key') != key:
+            return False
+        for attr, model in self.SECTIONS.items():
+            if attr in self.SECRETS:
+                continue
+            if attr not in snapshot:
+                return False
+            setattr(self, attr, model.construct(**snapshot[attr]))
+        return True
+
+    def save_snapshot(self, path: str, key: str):
+        snapshot = {'key': key}
+        for attr in self.SECTIONS:
+            if attr not in self.SECRETS:
+                snapshot[attr] = json.loads(getattr(self, attr).json())
+        try:
+            # Only for this user's eyes all the same: it's the whole configuration, hostnames and all
+            fd = os.open(f"{path}.tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with open(fd, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(f"{path}.tmp", path)
+        except OSError:
+            # Not being able to save a snapshot just means it'll be slower next time
+            pass
@@ -1,20 +1,33 @@
 import hashlib
 import json
 import logging
-from datetime import date
+import time
+import uuid
+from datetime import date, datetime, timedelta
+from typing import Callable, List, Optional
 
-from sqlalchemy import Table, Column, Numeric, String, DateTime, MetaData
-from sqlalchemy import create_engine, exc
+from sqlalchemy import Table, Column, Index, Float, Integer, Numeric, String, DateTime, MetaData
+from sqlalchemy import create_engine, exc, extract, func, cast
 from sqlalchemy.sql import select
 
 from inkystock.config import Config
 from inkystock.stocks.base import Point, Series
+from inkystock.trace import traced
 
 log = logging.getLogger("inkystock")
 
 
+class FillInProgress(Exception):
+    """
+    Another process is filling the cache entry, and didn't finish in time.
+    """
+
+
 class Database:
 
+    # Seconds between checks on a cache entry that another process is filling
+    POLL = 0.25
+
     def __init__(self, config: Config):
         self.config = config
         self.engine = create_engine(self.config.main.database)
@@ -29,8 +42,36 @@ class Database:
         self.cache = Table('cache', metadata,
                            Column('key', String, primary_key=True),
                            Column('value', String))
+        # Provider rate limits and credits (see stocks/scheduler.py), shared by every process using this database
+        self.quotas = Table('quotas', metadata,
+                            Column('key', String, primary_key=True),
+                            Column('tokens', Float),
+                            Column('updated', Float),
+                            Column('month', String),
+                            Column('credits', Integer),
+                            Column('retry_at', Float),
+                            Column('version', Integer))
+        # Who's filling which cache entry (see cached()), so only one process at a time calls the provider for it
+        self.leases = Table('leases', metadata,
+                            Column('key', String, primary_key=True),
+                            Column('holder', String),
+                            Column('expires', Float))
+        # Every query on prices is for one asset/currency/provider over a range of time. Databases created before the
+        # index existed won't get it from create_all(), so it's created separately.
+        self.prices_lookup = Index('prices_lookup',
+                                   self.prices.c.asset,
+                                   self.prices.c.currency,
+                                   self.prices.c.provider,
+                                   self.prices.c.datetime)
         metadata.create_all(self.engine)
+        self.prices_lookup.create(self.engine, checkfirst=True)
         self.conn = self.engine.connect()
+        # Identifies this connection's leases
+        self.holder = uuid.uuid4().hex
+
+    def close(self):
+        self.conn.close()
+        self.engine.dispose()
 
     def asset(self):
         if len(self.config.main.crypto):
@@ -38,14 +79,15 @@ class Database:
         else:
             return self.config.main.stock
 
-    def cache_key(self):
+    def cache_key(self, day: Optional[date] = None):
         m = hashlib.md5()
-        m.update(date.today().isoformat().encode('utf-8'))
+        m.update((day or date.today()).isoformat().encode('utf-8'))
         m.update(self.config.main.currency.encode('utf-8'))
         m.update(self.asset().encode('utf-8'))
         m.update(self.config.main.provider.encode('utf-8'))
         return m.hexdigest()
 
+    @traced("db.store_current")
     def store_current(self, current: Point) -> Point:
 
         ins = self.prices.insert().values(datetime=current.timestamp,
@@ -56,6 +98,20 @@ class Database:
         self.conn.execute(ins)
         return current
 
+    @traced("db.store_many")
+    def store_many(self, points: List[Point]):
+        """
+        Store a batch of prices in one go (e.g., from a streaming feed).
+        """
+        if not points:
+            return
+        self.conn.execute(self.prices.insert(), [dict(datetime=p.timestamp,
+                                                      currency=self.config.main.currency,
+                                                      provider=self.config.main.provider,
+                                                      asset=self.asset(),
+                                                      price=p.data) for p in points])
+
+    @traced("db.store_historical")
     def store_historical(self, historical: Series) -> Series:
         try:
             log.debug(f"Caching historical data with key {self.cache_key()}")
@@ -65,15 +121,83 @@ class Database:
             log.warning(e)
         return historical
 
-    def retrieve_historical(self) -> Series:
-        log.debug(f"Retrieving historical data with key {self.cache_key()}")
+    @traced("db.retrieve_historical")
+    def retrieve_historical(self, day: Optional[date] = None) -> Series:
+        """
+        :param day: the day the data was cached (default today); older caches are a fallback when the provider can't
+        be asked
+        :raises LookupError: if nothing was cached that day
+        """
+        log.debug(f"Retrieving historical data with key {self.cache_key(day)}")
         s = select([self.cache]) \
-            .where(self.cache.c.key == self.cache_key())
-        key, result = self.conn.execute(s).first()
+            .where(self.cache.c.key == self.cache_key(day))
+        row = self.conn.execute(s).first()
+        if row is None:
+            raise LookupError(f"No historical data cached with key {self.cache_key(day)}")
+        key, result = row
         log.debug(f"Historical data: {result}")
 
         return Series(series=json.loads(result)['series'])
 
+    def lease(self, key: str, seconds: float) -> bool:
+        """
+        Try to take the lease on a key, for a while. A lease that's expired (its holder went away without releasing
+        it) can be taken over.
+        """
+        now = time.time()
+        try:
+            self.conn.execute(self.leases.insert().values(key=key, holder=self.holder, expires=now + seconds))
+            return True
+        except exc.IntegrityError:
+            update = self.leases.update() \
+                .where(self.leases.c.key == key) \
+                .where(self.leases.c.expires < now) \
+                .values(holder=self.holder, expires=now + seconds)
+            return self.conn.execute(update).rowcount == 1
+
+    def release(self, key: str):
+        self.conn.execute(self.leases.delete()
+                          .where(self.leases.c.key == key)
+                          .where(self.leases.c.holder == self.holder))
+
+    def _cache_get(self, key: str) -> Optional[str]:
+        row = self.conn.execute(select([self.cache.c.value]).where(self.cache.c.key == key)).first()
+        return None if row is None else row[0]
+
+    @traced("db.cached")
+    def cached(self, key: str, fill: Callable[[], str], wait: Optional[float] = None,
+               lease: Optional[float] = None) -> str:
+        """
+        The cached value for the key, filled in with fill() (e.g., an expensive call to the provider) if it isn't there.
+
+        Only one process fills a key at a time: it holds the lease on it while it does. The others wait to see if it
+        turns up, and if it doesn't within `wait` seconds (default [Fetch] budget), raise FillInProgress, so they can
+        show something older instead.
+        :param lease: how long a fill can take (default twice [Fetch] timeout) before another process can take over
+        """
+        wait = self.config.fetch.budget if wait is None else wait
+        lease = 2 * self.config.fetch.timeout if lease is None else lease
+        deadline = time.monotonic() + wait
+        while True:
+            value = self._cache_get(key)
+            if value is not None:
+                return value
+            if self.lease(key, lease):
+                try:
+                    # It may have been filled between looking and taking the lease
+                    value = self._cache_get(key)
+                    if value is None:
+                        value = fill()
+                        self.conn.execute(self.cache.insert().values(key=key, value=value))
+                    return value
+                finally:
+                    self.release(key)
+            if time.monotonic() >= deadline:
+                raise FillInProgress(f"Another process is still filling the cache for {key}")
+            log.debug(f"Waiting on another process to fill the cache for {key}")
+            time.sleep(self.POLL)
+
+    @traced("db.recent")
     def recent(self) -> Series:
         s = select([self.prices]) \
             .where(self.prices.c.currency == self.config.main.currency) \
@@ -87,3 +211,50 @@ class Database:
             p = Point(timestamp=r[0], data=r[4])
             results.append(p)
         return Series(series=results)
+
+    def latest(self) -> Point:
+        """
+        The last price stored, for when the provider can't be asked.
+        """
+        results = self.recent().series
+        if not results:
+            raise LookupError(f"No stored prices for {self.asset()}")
+        return results[0]
+
+    @traced("db.movement")
+    def movement(self, minutes: int) -> float:
+        """
+        How far the price has moved over the last few minutes: the range of the stored prices, as a fraction of the
+        lowest. 0 with fewer than two prices.
+        """
+        since = datetime.now() - timedelta(minutes=minutes)
+        s = select([func.min(self.prices.c.price), func.max(self.prices.c.price), func.count()]) \
+            .where(self.prices.c.asset == self.asset()) \
+            .where(self.prices.c.currency == self.config.main.currency) \
+            .where(self.prices.c.provider == self.config.main.provider) \
+            .where(self.prices.c.datetime >= since)
+        low, high, count = self.conn.execute(s).first()
+        if count < 2 or not low:
+            return 0.0
+        return float(high - low) / abs(float(low))
+
+    @traced("db.intraday")
+    def intraday(self, hours: int, bucket_minutes: int) -> Series:
+        """
+        The stored prices for the last few hours, averaged into fixed buckets, oldest first.
+        The bucketing happens in the database, so only one row per bucket comes back however often prices are stored.
+        """
+        since = datetime.now() - timedelta(hours=hours)
+        # Seconds since the epoch, integer divided down to the bucket number (SQLite and PostgreSQL)
+        bucket = (cast(extract('epoch', self.prices.c.datetime), Integer) / (bucket_minutes * 60)).label('bucket')
+        s = select([bucket,
+                    func.min(self.prices.c.datetime).label('datetime'),
+                    func.avg(self.prices.c.price).label('price')]) \
+            .where(self.prices.c.asset == self.asset()) \
+            .where(self.prices.c.currency == self.config.main.currency) \
+            .where(self.prices.c.provider == self.config.main.provider) \
+            .where(self.prices.c.datetime >= since) \
+            .group_by(bucket) \
+            .order_by(bucket)
+        rs = self.conn.execute(s)
+        return Series(series=[Point(timestamp=r[1], data=r[2]) for r in rs])
@@ -2,7 +2,7 @@ import logging
 from copy import copy
 from dataclasses import dataclass
 from enum import Enum, auto
-from typing import List, Tuple, Any, Optional
+from typing import Any, Dict, List, Optional, Tuple
 
 from pydantic import BaseModel, validator
 
@@ -11,6 +11,14 @@ from inkystock import Element
 log = logging.getLogger("inkystock")
 
 
+def debugging() -> bool:
+    """
+    Is debug logging on? The layout and paint loops check before building their debug messages, since describing an
+    element can mean measuring it, and that work would otherwise be done for every element on every refresh.
+    """
+    return log.isEnabledFor(logging.DEBUG)
+
+
 class Align(Enum):
     LEFT = auto()
     RIGHT = auto()
@@ -90,7 +98,8 @@ class Container(Element):
         self._container_name = f"(Container name={self.name})"
 
     def __repr__(self):
-        return f"(Container name={self.name}, size={self.size()}, " \
+        # The size as last measured: working it out here would mean describing a container lays it out
+        return f"(Container name={self.name}, size={self._size}, " \
                f"border={self.border}, padding={self.padding}, display={self.display}, align={self.align}) "
 
     def add(self, element: Element):
@@ -124,9 +133,11 @@ class Container(Element):
         total_height = element_heights + self.padding.top + self.padding.bottom
 
         # if the width is not specified, expand the canvas to fit elements and padding
+        debug = debugging()
         if self._width == 0:
             width = total_width
-            log.debug(f"{self._container_name} expanding width to {width} to fit elements")
+            if debug:
+                log.debug(f"{self._container_name} expanding width to {width} to fit elements")
         else:
             if total_width > self._width:
                 log.warning(f"{self._container_name} will have elements outside the visible canvas (w:{total_width})")
@@ -134,7 +145,8 @@ class Container(Element):
         # If the height is not specified, expand the canvas to fit elements and padding
         if self._height == 0:
             height = total_height
-            log.debug(f"{self._container_name} expanding height to {height} to fit elements")
+            if debug:
+                log.debug(f"{self._container_name} expanding height to {height} to fit elements")
         else:
             if total_height > self._height:
                 log.warning(f"{self._container_name} will have elements outside the visible canvas (h:{total_height})")
@@ -144,7 +156,8 @@ class Container(Element):
         if height < 0:
             raise ValueError(f"Invalid canvas height: {height}")
 
-        log.debug(f"{self._container_name} width:{width}, height:{height}")
+        if debug:
+            log.debug(f"{self._container_name} width:{width}, height:{height}")
 
         self._size = width, height
         return self._size
@@ -179,20 +192,24 @@ class Layout:
     def _inline(self) -> LayoutList:
         layout: LayoutList = []
         min_x, min_y, max_x, max_y = self._container.boundaries()
-        log.debug(f"{self._container} INLINE container with boundaries x:{min_x}->{max_x}, y:{min_y}->{max_y}")
+        debug = debugging()
+        if debug:
+            log.debug(f"{self._container} INLINE container with boundaries x:{min_x}->{max_x}, y:{min_y}->{max_y}")
 
         position = Position(x=min_x, y=min_y)
 
         if self._container.align is Align.LEFT:
             for element in self._container.elements():
-                log.debug(f"{self._container} Placing {element} at {position}")
+                if debug:
+                    log.debug(f"{self._container} Placing {element} at {position}")
                 layout.append((copy(position), element))
                 position.x += element.width()
 
         if self._container.align is Align.RIGHT:
             position.x = max_x
             for element in self._container.elements():
-                log.debug(f"{self._container} Placing {element} at {position}")
+                if debug:
+                    log.debug(f"{self._container} Placing {element} at {position}")
                 position.x -= element.width()
                 layout.append((copy(position), element))
 
@@ -201,13 +218,16 @@ class Layout:
     def _block(self) -> LayoutList:
         layout: LayoutList = []
         min_x, min_y, max_x, max_y = self._container.boundaries()
-        log.debug(f"{self._container} BLOCK container with boundaries x:{min_x}->{max_x}, y:{min_y}->{max_y}")
+        debug = debugging()
+        if debug:
+            log.debug(f"{self._container} BLOCK container with boundaries x:{min_x}->{max_x}, y:{min_y}->{max_y}")
 
         position = Position(x=min_x, y=min_y)
 
         if self._container.align is Align.LEFT:
             for element in self._container.elements():
-                log.debug(f"{self._container} Placing {element} at {position}")
+                if debug:
+                    log.debug(f"{self._container} Placing {element} at {position}")
                 layout.append((copy(position), element))
                 position.y += element.height()
 
@@ -215,7 +235,8 @@ class Layout:
             for element in self._container.elements():
                 position.x = max_x
                 position.x -= element.width()
-                log.debug(f"{self._container} Placing {element} at {position}")
+                if debug:
+                    log.debug(f"{self._container} Placing {element} at {position}")
                 layout.append((copy(position), element))
                 position.y += element.height()
 
@@ -228,3 +249,25 @@ class Layout:
             return self._inline()
         else:
             log.error(f"{self._container.display} is not recognized, skipping (Container name={self._container.name})")
+
+
+def describe(layout: LayoutList) -> List[Dict[str, Any]]:
+    """
+    The layout as a tree of plain data (e.g., to dump as JSON), with positions relative to the containing element.
+    Containers are laid out again to describe their contents, so this is for debugging rather than every refresh.
+    """
+    tree = []
+    for position, element in layout:
+        width, height = element.size()
+        node: Dict[str, Any] = {"type": type(element).__name__, "x": position.x, "y": position.y,
+                                "width": width, "height": height}
+        if isinstance(element, Container):
+            node.update({
+                "name": element.name, "display": element.display.name, "align": element.align.name,
+                "padding": element.padding.dict(), "border": element.border.dict(),
+                "elements": describe(Layout(element).layout()),
+            })
+        else:
+            node["element"] = repr(element)
+        tree.append(node)
+    return tree
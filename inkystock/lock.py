@@ -0,0 +1,166 @@
+"""
+Keeps runs from cron piling up.
+
+cron starts a run every five minutes whether or not the last one has finished. When the provider's slow (or it's the
+midnight historical fetch) on a single core Pi Zero, overlapping runs fight over the SQLite file and the SPI bus, and
+make each other slower still. So a run takes a lock first. If another run has it, it either gives up straight away, or
+(the default) leaves a note asking the running one to go again once it's done: however many runs turn up in the
+meantime, that's a single follow-up run, with the latest data.
+
+The lock file also records the run in flight and how long the last one took, to make it easy to spot an interval
+that's too tight.
+"""
+import fcntl
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, Optional
+
+log = logging.getLogger("inkystock")
+
+
+class Overlap:
+    """
+    What a run does when another one is still going.
+    """
+    # Exit straight away
+    SKIP = "skip"
+    # Ask the running one to go again when it's done
+    COALESCE = "coalesce"
+
+
+class RunLock:
+
+    def __init__(self, path: str, overlap: str = Overlap.COALESCE):
+        self.path = path
+        self.pending_path = f"{path}.pending"
+        self.overlap = overlap
+        self._fd: Optional[int] = None
+
+    def __repr__(self):
+        return f"(RunLock path={self.path}, overlap={self.overlap}, held={self._fd is not None})"
+
+    def acquire(self, follow_up: bool = True) -> bool:
+        """
+        Take the lock if it's free, without waiting.
+        :param follow_up: if another run has the lock, ask it for a follow-up run (when coalescing)
+        :return: whether the lock was taken
+        """
+        try:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        except OSError as e:
+            # Better to risk an overlap than to stop updating the display
+            log.warning(f"Couldn't open the lock file, running without it: {e}")
+            return True
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            pid = self.state().get("running", {}).get("pid")
+            running = f"Run {pid}" if pid else "Another run"
+            if follow_up and self.overlap == Overlap.COALESCE:
+                with open(self.pending_path, "a"):
+                    pass
+                log.info(f"{running} is still going, asked it for a follow-up run")
+            else:
+                log.info(f"{running} is still going, skipping this one")
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+    def state(self) -> Dict[str, Any]:
+        """
+        The run in flight (if any) and the last one to finish, from the lock file.
+        """
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state: Dict[str, Any]):
+        # Only the run holding the lock writes to it
+        if self._fd is None:
+            return
+        data = json.dumps(state).encode('utf-8')
+        os.ftruncate(self._fd, 0)
+        os.pwrite(self._fd, data, 0)
+
+    def started(self):
+        state = self.state()
+        state["running"] = {"pid": os.getpid(), "started": time.time()}
+        self._save_state(state)
+
+    def finished(self, duration: float, due: Optional[float] = None):
+        """
+        :param due: when the next run is due (a timestamp), if the run knows
+        """
+        state = self.state()
+        state.pop("running", None)
+        state["last"] = {"pid": os.getpid(), "finished": time.time(), "duration": duration}
+        if due is not None:
+            state["due"] = due
+        else:
+            state.pop("due", None)
+        self._save_state(state)
+
+    def due(self) -> Optional[float]:
+        """
+        When the next run is due, as recorded by the last one.
+        """
+        return self.state().get("due")
+
+    def pending(self) -> bool:
+        """
+        Has a follow-up run been asked for? Clears the request, so runs turning up during the follow-up ask again.
+        """
+        try:
+            os.remove(self.pending_path)
+            return True
+        except FileNotFoundError:
+            return False
+
+
+def coalesced(lock: RunLock, run: Callable[[], Optional[float]], interval: Optional[float] = None) -> int:
+    """
+    Run, then go again for as long as follow-up runs are asked for.
+    :param run: the run, returning the seconds until the next one is due, if it knows
+    :param interval: seconds between scheduled runs, to warn when a run takes longer than that
+    :return: the number of runs, 0 if another run had the lock
+    """
+    runs = 0
+    follow_up = True
+    while lock.acquire(follow_up):
+        # This run covers any follow-up already asked for
+        lock.pending()
+        try:
+            while True:
+                lock.started()
+                started = time.monotonic()
+                wall = time.time()
+                after = None
+                try:
+                    after = run()
+                finally:
+                    duration = time.monotonic() - started
+                    lock.finished(duration, None if after is None else wall + after)
+                runs += 1
+                if interval is not None and duration > interval:
+                    log.warning(f"Run took {duration:.0f}s, longer than the {interval:.0f}s between runs")
+                if not lock.pending():
+                    break
+                log.info("Going again, as another run was asked for in the meantime")
+        finally:
+            lock.release()
+        # A run that turned up between checking for follow-ups and releasing the lock
+        if not os.path.exists(lock.pending_path):
+            break
+        follow_up = False
+    return runs
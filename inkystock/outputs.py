@@ -0,0 +1,376 @@
+"""
+Outputs are where a painted frame ends up once it's been composed. The e-ink panel is the one that matters, but it's
+handy to mirror frames elsewhere too: a snapshot on disk, a raw framebuffer, a web dashboard, etc.
+
+Each output is a "sink". Every sink gets the same frame and runs on its own worker thread, so a slow sink (the SD card,
+a dashboard that's gone away) never holds up the panel refresh.
+"""
+import abc
+import hashlib
+import io
+import json
+import logging
+import os
+import queue
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from PIL import Image as PILImage
+
+from inkystock.config import Config
+from inkystock.paint import Painter, PillowImage
+from inkystock.trace import span
+
+log = logging.getLogger("inkystock")
+
+# Set in a frame's info by whatever rendered it (see main.render): a digest of what the frame shows, other than the
+# clock in the status bar
+CONTENT = "inkystock.content"
+
+
+def content_digest(*shown) -> str:
+    return hashlib.sha1(repr(shown).encode('utf-8')).hexdigest()
+
+
+def write_atomic(path: str, data: bytes):
+    """
+    Write to a temporary file first so anything watching the path never sees a partial file.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class Sink(abc.ABC):
+    """
+    Something that consumes painted frames. Sinks must treat the frame as read-only, since it's shared.
+    """
+    name = "sink"
+    # Only the newest frame waiting for this sink is kept; older ones are dropped rather than written one after another
+    coalesce = False
+
+    def __repr__(self):
+        return f"({self.__class__.__name__} name={self.name})"
+
+    @abc.abstractmethod
+    def write(self, frame: PILImage.Image):
+        pass
+
+    def close(self):
+        pass
+
+
+class InkySink(Sink):
+    """
+    The Inky pHAT itself. A panel refresh takes several seconds, so a frame that's been superseded while waiting for
+    the previous one to finish isn't worth showing.
+    """
+    name = "inky"
+    coalesce = True
+
+    def __init__(self, painter: Painter):
+        self.painter = painter
+
+    def write(self, frame: PILImage.Image):
+        self.painter.display(PillowImage(frame))
+
+
+class SnapshotPolicy:
+    """
+    When a snapshot of the painted frame gets written to disk.
+    """
+    ALWAYS = "always"
+    # Only write when what the frame shows differs from the last one written (the clock aside)
+    CHANGED = "changed"
+    # Write every Nth frame
+    EVERY = "every"
+    # Keep a rotating set of the last N frames
+    HISTORY = "history"
+
+
+class SnapshotSink(Sink):
+    """
+    Writes snapshots of painted frames to disk (PNG by default), according to the configured policy.
+
+    State (frame counter, digest of the last frame written) is kept in a small JSON file next to the snapshot, so
+    policies like "every N frames" work across cron invocations. It's read once, and only written along with a snapshot
+    (or on close, for "every", whose count has to carry over to the next run).
+    """
+    name = "png"
+
+    def __init__(self, config: Config):
+        self.path = config.outputs.local
+        self.policy = config.outputs.snapshot
+        self.every = config.outputs.snapshot_every
+        self.history = config.outputs.snapshot_history
+        self.compress_level = config.outputs.snapshot_compress_level
+        self.state_path = f"{self.path}.state"
+        self._state: Optional[dict] = None
+        # The frame counter has moved on since the state was last written
+        self._unsaved = False
+
+    def __repr__(self):
+        return f"(SnapshotSink path={self.path}, policy={self.policy})"
+
+    def _load_state(self) -> dict:
+        if self._state is None:
+            try:
+                with open(self.state_path) as f:
+                    self._state = json.load(f)
+            except (OSError, ValueError):
+                self._state = {}
+        return self._state  # type: ignore
+
+    def _save_state(self, state: dict):
+        with open(self.state_path, "w") as f:
+            json.dump(state, f)
+
+    def _history_path(self, frame: int) -> str:
+        root, ext = os.path.splitext(self.path)
+        return f"{root}.{(frame - 1) % self.history}{ext}"
+
+    def target(self, frame: int, digest: str, state: dict) -> Optional[str]:
+        """
+        Work out where (if anywhere) this frame should be written.
+        """
+        if self.policy == SnapshotPolicy.CHANGED and digest == state.get("digest"):
+            return None
+        if self.policy == SnapshotPolicy.EVERY and (frame - 1) % self.every:
+            return None
+        if self.policy == SnapshotPolicy.HISTORY:
+            return self._history_path(frame)
+        return self.path
+
+    def _save(self, path: str, frame: PILImage.Image):
+        params = {}
+        fmt = PILImage.registered_extensions().get(os.path.splitext(path)[1].lower())
+        if fmt == "PNG":
+            params["compress_level"] = self.compress_level
+        with io.BytesIO() as f:
+            frame.save(f, format=fmt, **params)
+            write_atomic(path, f.getvalue())
+
+    def write(self, frame: PILImage.Image):
+        if self.policy == SnapshotPolicy.ALWAYS:
+            # Nothing to compare against or count, so there's no state to keep
+            self._save(self.path, frame)
+            log.debug(f"Wrote snapshot to {self.path}")
+            return
+
+        state = self._load_state()
+        number = state.get("frame", 0) + 1
+        state["frame"] = number
+
+        if CONTENT in frame.info:
+            # Otherwise the clock would make every frame different
+            digest = content_digest(frame.mode, frame.size, frame.info[CONTENT])
+        else:
+            m = hashlib.sha1()
+            m.update(repr((frame.mode, frame.size)).encode('utf-8'))
+            m.update(frame.tobytes())
+            digest = m.hexdigest()
+
+        path = self.target(number, digest, state)
+        if path is None:
+            log.debug(f"Skipping snapshot of frame {number} ({self.policy})")
+            self._unsaved = True
+            return
+
+        self._save(path, frame)
+        log.debug(f"Wrote snapshot of frame {number} to {path}")
+        state["digest"] = digest
+        state["latest"] = path
+        self._save_state(state)
+        self._unsaved = False
+
+    def close(self):
+        # Only "every" needs to know how many frames were skipped since the last snapshot
+        if self._unsaved and self.policy == SnapshotPolicy.EVERY:
+            self._save_state(self._load_state())
+            self._unsaved = False
+
+
+class RawSink(Sink):
+    """
+    Dumps the framebuffer as-is: one palette index per pixel, row by row. Width and height are the display's.
+    """
+    name = "raw"
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, frame: PILImage.Image):
+        write_atomic(self.path, frame.tobytes())
+
+
+class HTTPSink(Sink):
+    """
+    Serves the most recent frame from memory over HTTP, as /frame.png or /frame.raw.
+    Only really useful in a long-running process; a cron invocation exits as soon as the panel is updated.
+    """
+    name = "http"
+
+    def __init__(self, host: str, port: int):
+        self._frames: Dict[str, bytes] = {}
+        frames = self._frames
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                types = {"/frame.png": "image/png", "/frame.raw": "application/octet-stream"}
+                path = "/frame.png" if self.path == "/" else self.path
+                body = frames.get(path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", types[path])
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log.debug(f"HTTP sink: {fmt % args}")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self._thread = threading.Thread(target=self.server.serve_forever, name="http-sink", daemon=True)
+        self._thread.start()
+        log.info(f"Serving frames on http://{host}:{self.server.server_address[1]}/frame.png")
+
+    def write(self, frame: PILImage.Image):
+        with io.BytesIO() as f:
+            frame.save(f, format="PNG")
+            png = f.getvalue()
+        # Swap in a whole new dict entry at a time, so requests never see a half-updated frame
+        self._frames["/frame.png"] = png
+        self._frames["/frame.raw"] = frame.tobytes()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class SocketSink(Sink):
+    """
+    Pushes each frame to whatever is listening on a Unix socket: a one-line JSON header followed by the raw
+    framebuffer. Nobody listening isn't an error, the frame is just dropped.
+    """
+    name = "socket"
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path = path
+        self.timeout = timeout
+
+    def write(self, frame: PILImage.Image):
+        data = frame.tobytes()
+        header = json.dumps({"width": frame.width, "height": frame.height, "mode": frame.mode, "length": len(data)})
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                s.settimeout(self.timeout)
+                s.connect(self.path)
+                s.sendall(header.encode('utf-8') + b"\n" + data)
+        except (FileNotFoundError, ConnectionRefusedError) as e:
+            log.debug(f"Nothing listening on {self.path}, dropping frame: {e}")
+
+
+class SinkWorker:
+    """
+    Feeds frames to a sink on a dedicated thread.
+    """
+
+    def __init__(self, sink: Sink):
+        self.sink = sink
+        # A coalescing sink has room for one pending frame (plus the one it's writing)
+        self._queue: "queue.Queue[Optional[PILImage.Image]]" = queue.Queue(maxsize=1 if sink.coalesce else 0)
+        self._thread = threading.Thread(target=self._run, name=f"{sink.name}-sink", daemon=True)
+        self._thread.start()
+
+    def submit(self, frame: PILImage.Image):
+        while True:
+            try:
+                self._queue.put_nowait(frame)
+                return
+            except queue.Full:
+                pass
+            try:
+                self._queue.get_nowait()
+                log.debug(f"{self.sink} is still busy, dropping its pending frame for a newer one")
+            except queue.Empty:
+                # The worker took it in the meantime
+                pass
+
+    def close(self, timeout: Optional[float] = None):
+        try:
+            # Waits behind a coalescing sink's pending frame, which should still be shown
+            self._queue.put(None, timeout=timeout)
+        except queue.Full:
+            log.warning(f"{self.sink} still busy after {timeout}s, giving up on it")
+            return
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            log.warning(f"{self.sink} still busy after {timeout}s, giving up on it")
+            return
+        self.sink.close()
+
+    def _run(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                return
+            try:
+                with span(f"sink.{self.sink.name}"):
+                    self.sink.write(frame)
+            except Exception as e:
+                log.error(f"{self.sink} failed to write frame: {e}")
+
+
+def sinks(config: Config, painter: Painter) -> List[Sink]:
+    """
+    Create the sinks named in the configuration.
+    """
+    results: List[Sink] = []
+    for name in config.outputs.sinks:
+        if name == "inky":
+            results.append(InkySink(painter))
+        elif name == "png":
+            results.append(SnapshotSink(config))
+        elif name == "raw":
+            results.append(RawSink(config.outputs.raw))
+        elif name == "http":
+            results.append(HTTPSink(config.outputs.http_host, config.outputs.http_port))
+        elif name == "socket":
+            results.append(SocketSink(config.outputs.socket))
+        else:
+            raise NotImplementedError(f"There is no output sink available for {name}")
+    return results
+
+
+class Outputs:
+    """
+    Fans a painted frame out to every configured sink at once.
+    """
+
+    def __init__(self, config: Config, painter: Painter):
+        self.workers = [SinkWorker(sink) for sink in sinks(config, painter)]
+
+    def __repr__(self):
+        return f"(Outputs sinks={[w.sink.name for w in self.workers]})"
+
+    def publish(self, image: PillowImage):
+        """
+        Hand the frame to every sink. Returns immediately, so in a long-running process the next frame can be fetched
+        and rendered while the panel is still refreshing.
+        """
+        # Copy once, so the caller is free to keep mutating (rotating, etc) the image it handed over
+        frame = image.render().copy()
+        for worker in self.workers:
+            worker.submit(frame)
+
+    def close(self, timeout: Optional[float] = None):
+        """
+        Wait for every sink to finish with the frames it's been handed.
+        """
+        for worker in self.workers:
+            worker.close(timeout)
@@ -5,6 +5,7 @@ but it helps keep parts of the system to do with "painting" separate from the la
 """
 import abc
 import logging
+from functools import lru_cache
 from typing import Sequence, Tuple
 
 # I want to use the Image name myself, renaming the others for consistency
@@ -12,7 +13,9 @@ from PIL import ImageFont as PILFont, Image as PILImage, ImageDraw as PILDraw
 from inky.auto import auto
 
 from inkystock import Element
-from inkystock.layout import LayoutList, Container, Layout, Border
+from inkystock.atlas import atlas, rasterize
+from inkystock.layout import LayoutList, Container, Layout, Border, debugging
+from inkystock.trace import traced
 
 log = logging.getLogger("inkystock")
 
@@ -55,6 +58,26 @@ class Palette:
 class Color:
     BLACK = 1
     WHITE = 0
+    # Red or yellow, depending on the panel
+    ACCENT = 2
+
+
+@lru_cache(maxsize=64)
+def truetype(font: str, font_size: int) -> PILFont.FreeTypeFont:
+    """
+    Fonts are loaded once per process and shared, since loading the TTF is a big chunk of the cost of drawing text.
+    """
+    return PILFont.truetype(font, font_size)
+
+
+@lru_cache(maxsize=64)
+def sprite(path: str) -> PILImage.Image:
+    """
+    Images from disk (e.g., mascots) are decoded once per process and shared. Treat as read-only; copy before drawing.
+    """
+    img = PILImage.open(path)
+    img.load()
+    return img
 
 
 class Image(Element):
@@ -107,7 +130,8 @@ class PillowImage(Image):
     def border(self, border: Border):
         if border == Border():
             return self
-        log.debug(f"Drawing {border}")
+        if debugging():
+            log.debug(f"Drawing {border}")
 
         draw = PILDraw.Draw(self.image)
         width, height = self.size()
@@ -184,8 +208,12 @@ class Painter(abc.ABC):
 
 class Pillow(Painter):
 
-    def __init__(self, config):
+    def __init__(self, config, board=None):
+        """
+        :param board: the Inky board to display on, detected when first needed if not given
+        """
         self.config = config
+        self.board = board
 
     def canvas(self, size):
         if self.config.main.color in ['red', 'yellow']:
@@ -201,8 +229,7 @@ class Pillow(Painter):
         return PillowImage(canvas)
 
     def from_file(self, path):
-        img = PILImage.open(path)
-        return PillowImage(img)
+        return PillowImage(sprite(path).copy())
 
     def text(self, text, font: str, font_size: int) -> Text:
         """
@@ -212,21 +239,19 @@ class Pillow(Painter):
         :param font_size:
         :return: Image
         """
-        # Initialize the font
-        ttf = PILFont.truetype(font, int(font_size))
-
-        # Get the dimensions of the font that *would* be rendered, then create a temporary canvas
-        # with those dimensions to draw on.
-        bbox = ttf.getbbox(text)
-        width = bbox[2] - bbox[0]
-        height = bbox[3]  # have to ignore bbox[1] because it produces cropped text
-        size = (width, height)
-        log.debug(f"Bounding box for {text}: {bbox}, size: {size}")
-        canvas = self.canvas(size)
-        draw = PILDraw.Draw(canvas)
+        # Pixel fonts are drawn from their glyph atlas where possible (see inkystock/atlas.py), which is much quicker
+        # than FreeType, and the same pixels.
+        glyphs = atlas(font, int(font_size), self.config.fonts.atlas)
+        if glyphs is not None and glyphs.covers(text):
+            mask = glyphs.compose(text)
+        else:
+            mask = rasterize(truetype(font, int(font_size)), text)
+        if debugging():
+            log.debug(f"Size of {text}: {mask.size}")
 
-        # Draw the text to the temporary canvas.
-        draw.text((0, 0), text, Color.BLACK, font=ttf)
+        # Create a temporary canvas with those dimensions, and draw the text to it.
+        canvas = self.canvas(mask.size)
+        canvas.paste(Color.BLACK, (0, 0), mask=mask)
 
         return Text(image=PillowImage(canvas), text=text, font=font, font_size=font_size)
 
@@ -256,16 +281,20 @@ class Pillow(Painter):
         return PillowImage(canvas)
 
     def display(self, image: PillowImage):
-        board = auto()
-        board.set_image(image.render())
-        board.show()
+        # Detected once and kept, since a long-running process displays over and over
+        if self.board is None:
+            self.board = auto()
+        self.board.set_image(image.render())
+        self.board.show()
 
+    @traced("paint")
     def paint(self, size: Tuple[int, int], layout: LayoutList):
         if self.config.main.color in ['red', 'yellow']:
             palette = Palette.color()
         else:
             palette = Palette.black_and_white()
         canvas = self.new(size).render()
+        debug = debugging()
         for position, element in layout:
             if type(element) is Container:
                 content = self.paint(element.size(), Layout(element).layout())
@@ -273,7 +302,8 @@ class Pillow(Painter):
                 canvas.paste(bordered.render(), (position.x, position.y))
             else:
                 image = element.render()
-                log.info(f"Rendering {element} to canvas, size: {image.size} position: {position}")
+                if debug:
+                    log.debug(f"Rendering {element} to canvas, size: {image.size} position: {position}")
                 # Use alpha blending where applicable (e.g., mascots)
                 mask = None
                 if image.mode == 'RGBA':
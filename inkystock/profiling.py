@@ -0,0 +1,83 @@
+"""
+Opt-in profiling of a refresh, for when a Pi in the field gets slow and the timings (see trace.py) aren't enough.
+
+Each profiled refresh writes two files to the profile directory:
+ - <timestamp>.pstats: cProfile stats, for `python -m pstats` or snakeviz
+ - <timestamp>.txt: a summary of the top functions by cumulative time, and the top allocations (tracemalloc)
+
+Only the most recent profiles are kept, so leaving profiling switched on can't fill the SD card.
+"""
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Iterator, List
+
+log = logging.getLogger("inkystock")
+
+
+def rotate(directory: str, keep: int):
+    """
+    Delete all but the most recent `keep` profiles.
+    """
+    stems = sorted({os.path.splitext(name)[0] for name in os.listdir(directory)
+                    if name.endswith(".pstats") or name.endswith(".txt")})
+    for stem in stems[:-keep]:
+        for ext in [".pstats", ".txt"]:
+            path = os.path.join(directory, stem + ext)
+            if os.path.exists(path):
+                os.remove(path)
+
+
+@contextmanager
+def profiled(directory: str, keep: int = 10, top: int = 25) -> Iterator[None]:
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, datetime.now().strftime("%Y%m%d-%H%M%S"))
+
+    profilers: List[cProfile.Profile] = [cProfile.Profile()]
+    # Before Python 3.12, cProfile only sees the thread it was enabled on, so give each new thread (e.g., the
+    # background chart build, the outputs) its own profiler and merge them at the end.
+    per_thread = sys.version_info < (3, 12)
+
+    def thread_profiler(*args):
+        profiler = cProfile.Profile()
+        profilers.append(profiler)
+        profiler.enable()
+
+    tracemalloc.start()
+    if per_thread:
+        threading.setprofile(thread_profiler)
+    profilers[0].enable()
+    try:
+        yield
+    finally:
+        profilers[0].disable()
+        if per_thread:
+            threading.setprofile(None)  # type: ignore
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        stats = pstats.Stats(profilers[0])
+        for profiler in profilers[1:]:
+            stats.add(profiler)
+        stats.dump_stats(f"{stem}.pstats")
+
+        summary = io.StringIO()
+        summary.write(f"Peak traced memory: {peak / 1024:.1f} KiB\n\n")
+        summary.write(f"Top {top} allocations by line:\n")
+        for stat in snapshot.statistics("lineno")[:top]:
+            summary.write(f"  {stat}\n")
+        summary.write(f"\nTop {top} functions by cumulative time:\n")
+        pstats.Stats(f"{stem}.pstats", stream=summary).sort_stats("cumulative").print_stats(top)
+        with open(f"{stem}.txt", "w") as f:
+            f.write(summary.getvalue())
+
+        rotate(directory, keep)
+        log.info(f"Wrote profile to {stem}.pstats (summary in {stem}.txt)")
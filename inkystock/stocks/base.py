@@ -1,8 +1,10 @@
 import logging
 from abc import ABC, abstractmethod
-from datetime import datetime
-from typing import List
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Dict, Iterator, List, Optional
 
+import requests
 from forex_python.converter import CurrencyRates
 from pydantic import BaseModel
 
@@ -24,10 +26,41 @@ class Series(BaseModel):
 class Stock(ABC):
     PROVIDER_CURRENCY = 'EUR'
     CACHE_HISTORICAL = False
+    # Limits of the provider's free plan, which the scheduler sticks to unless [Quota] says otherwise. 0 is unlimited.
+    CALLS_PER_MINUTE = 0.0
+    MONTHLY_CREDITS = 0
+    # What a call to current()/historical() costs against the monthly credits
+    CREDITS: Dict[str, int] = {'current': 1, 'historical': 1}
+    # Prices only change while the exchange is open (see market.py)
+    MARKET_HOURS = False
 
     def __init__(self, config: Config):
         self.config = config
         self.currency = CurrencyRates()
+        # Seconds the provider asked us to wait, if it's responded with a 429 (see rate_limited)
+        self.retry_after: Optional[float] = None
+
+    def rate_limited(self, response: requests.Response, *args, **kwargs):
+        """
+        A requests response hook: takes note of the Retry-After header (seconds, or an HTTP date) on a 429.
+        """
+        if response.status_code != 429:
+            return
+        header = response.headers.get('Retry-After', '60')
+        try:
+            self.retry_after = float(header)
+        except ValueError:
+            try:
+                self.retry_after = (parsedate_to_datetime(header) - datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                self.retry_after = 60.0
+        log.warning(f"Rate limited by {response.url.split('?')[0]}, asked to retry after {self.retry_after:.0f}s")
+
+    def cost(self, name: str) -> int:
+        """
+        What a call to current()/historical() costs against the monthly credits, for this asset.
+        """
+        return self.CREDITS.get(name, 1)
 
     def currency_convert(self, amount) -> float:
         if self.PROVIDER_CURRENCY == self.config.main.currency:
@@ -42,3 +75,22 @@ class Stock(ABC):
     @abstractmethod
     def current(self) -> Point:
         pass
+
+
+class Streaming(ABC):
+    """
+    A provider that pushes prices as they change, rather than being polled (see stream.py).
+    """
+
+    def __init__(self, config: Config):
+        self.config = config
+
+    @abstractmethod
+    def ticks(self) -> Iterator[Point]:
+        """
+        Yields prices as they arrive. Returns (or raises) when the feed ends; it's up to the caller to reconnect.
+        """
+        pass
+
+    def close(self):
+        pass
@@ -41,11 +41,23 @@ class CustomCoinGeckoAPI(CoinGeckoAPI):
 class CoinGecko(Stock):
     PROVIDER_CURRENCY = 'USD'
     CACHE_HISTORICAL = True  # Retrieving a large range, so use a daily cache
+    # Demo plan
+    CALLS_PER_MINUTE = 30
+    MONTHLY_CREDITS = 10000
 
     def __init__(self, config: Config):
         super().__init__(config)
         self.PROVIDER_CURRENCY = self.config.main.currency  # CoinGecko supports currency conversion natively
         self.cg = CustomCoinGeckoAPI(demo_api_key=config.coingecko.api_key)
+        # The library's default is two minutes
+        self.cg.request_timeout = config.fetch.timeout
+        # The library only retries on 5xx, so a 429 goes straight back to the caller, minus its headers
+        self.cg.session.hooks['response'].append(self.rate_limited)
+
+    def cost(self, name: str) -> int:
+        # Anything other than BTC costs an extra call to look up its ID (see symbol_to_id)
+        lookup = 0 if self.config.main.crypto.lower() == 'btc' else 1
+        return super().cost(name) + lookup
 
     def symbol_to_id(self):
         symbol = self.config.main.crypto.lower()
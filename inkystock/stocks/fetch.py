@@ -0,0 +1,43 @@
+"""
+Calls to the provider that the refresh can stop waiting for.
+
+A provider that's slow or down shouldn't leave the panel showing an old frame with no sign anything's wrong. The call
+runs on its own thread: if it doesn't answer within the latency budget, the refresh carries on with the last stored
+price (and says so in the status bar), and picks up the answer at the end if it turns up, ready for next time.
+"""
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, Generic, TypeVar
+
+log = logging.getLogger("inkystock")
+
+T = TypeVar("T")
+
+
+class Fetch(Generic[T]):
+
+    def __init__(self, call: Callable[[], T], name: str = "fetch"):
+        self.name = name
+        self._future: "Future[T]" = Future()
+        # A daemon thread rather than an executor, so a call that never returns can't stop the process exiting
+        self._thread = threading.Thread(target=self._run, args=(call,), name=name, daemon=True)
+        self._thread.start()
+
+    def __repr__(self):
+        return f"(Fetch name={self.name}, done={self.done()})"
+
+    def _run(self, call: Callable[[], T]):
+        try:
+            self._future.set_result(call())
+        except BaseException as e:
+            self._future.set_exception(e)
+
+    def done(self) -> bool:
+        return self._future.done()
+
+    def result(self, timeout: float) -> T:
+        """
+        The answer, or whatever the call raised. Raises TimeoutError if it's still going after `timeout` seconds.
+        """
+        return self._future.result(timeout)
@@ -14,17 +14,30 @@ log = logging.getLogger("inkystock")
 class IEX(Stock):
     PROVIDER_CURRENCY = 'USD'
     CACHE_HISTORICAL = True  # retrieving historical data for IEX uses a lot of credits, so only use it once per day
+    # Free tier
+    MONTHLY_CREDITS = 50000
+    # latestPrice is 1 credit; a close-only chart is 2 credits per trading day, and a month has ~21 of them
+    CREDITS = {'current': 1, 'historical': 42}
+    MARKET_HOURS = True
 
     def __init__(self, config: Config):
         super().__init__(config)
         log.debug(f"IEX Endpoint: {config.iex.endpoint}")
+        self.session = requests.Session()
+        self.session.hooks['response'].append(self.rate_limited)
+
+    def get(self, path: str, params: Dict) -> requests.Response:
+        r = self.session.get(f"{self.config.iex.endpoint}{path}", params=params, timeout=self.config.fetch.timeout)
+        # Otherwise an error message ends up being parsed as a price
+        r.raise_for_status()
+        return r
 
     def current(self) -> Point:
         if len(self.config.main.crypto):
             raise NotImplementedError("Crypto not implemented for IEX Provider")
 
         params: Dict[str, str] = {'token': self.config.iex.token}
-        r = requests.get(f"{self.config.iex.endpoint}/stock/{self.config.main.stock}/quote/latestPrice", params=params)
+        r = self.get(f"/stock/{self.config.main.stock}/quote/latestPrice", params=params)
         return Point(timestamp=datetime.now(), data=self.currency_convert(r.text))
 
     def historical(self) -> Series:
@@ -32,7 +45,7 @@ class IEX(Stock):
             raise NotImplementedError("Crypto not implemented for IEX Provider")
 
         params: Dict[str, Union[str, bool]] = {'token': self.config.iex.token, 'chartCloseOnly': True}
-        r = requests.get(f"{self.config.iex.endpoint}/stock/{self.config.main.stock}/chart/1m", params=params)
+        r = self.get(f"/stock/{self.config.main.stock}/chart/1m", params=params)
         results = []
         for day in r.json():
             p = Point(timestamp=datetime.strptime(day['date'], '%Y-%m-%d'), data=self.currency_convert(day['close']))
@@ -0,0 +1,143 @@
+"""
+Exchange trading hours, so stock providers aren't asked for a price that can't have changed.
+
+A stock's price only moves while its exchange is open. Fetching it every five minutes around the clock spends most of
+the provider's credits (IEX's free plan, in particular) on overnight and weekend prices that are just the last close.
+Outside trading hours, once the close has been stored, a refresh does nothing: no call to the provider, and no panel
+refresh, since the display is already showing the close.
+
+The session and time zone come from [Market] in config.ini (the NYSE/Nasdaq regular session by default). Holidays are
+worked out offline from the NYSE's rules; one-off closures can be added in the config. Early closes (e.g., the day
+after Thanksgiving) aren't known about, so those afternoons see a few unchanged prices fetched.
+"""
+import logging
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import FrozenSet, Optional
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # Python < 3.9, e.g., Raspberry Pi OS
+    from backports.zoneinfo import ZoneInfo  # type: ignore
+
+from inkystock.config import Config
+from inkystock.stocks.base import Stock
+
+log = logging.getLogger("inkystock")
+
+DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+
+def easter(year: int) -> date:
+    """
+    Easter Sunday, by the anonymous Gregorian algorithm.
+    """
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    j = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * j) // 451
+    month, day = divmod(h + j - 7 * m + 114, 31)
+    return date(year, month, day + 1)
+
+
+def nth_weekday(year: int, month: int, weekday: int, n: int) -> date:
+    """
+    The nth weekday (0 is Monday) of the month, or the last one if n is -1.
+    """
+    if n > 0:
+        first = date(year, month, 1)
+        return first + timedelta(days=(weekday - first.weekday()) % 7 + 7 * (n - 1))
+    last = date(year + month // 12, month % 12 + 1, 1) - timedelta(days=1)
+    return last - timedelta(days=(last.weekday() - weekday) % 7)
+
+
+def observed(day: date) -> date:
+    """
+    Holidays falling on a Saturday are observed on the Friday before, and on a Sunday the Monday after.
+    """
+    if day.weekday() == 5:
+        return day - timedelta(days=1)
+    if day.weekday() == 6:
+        return day + timedelta(days=1)
+    return day
+
+
+@lru_cache(maxsize=None)
+def nyse_holidays(year: int) -> FrozenSet[date]:
+    days = {
+        nth_weekday(year, 1, 0, 3),  # Martin Luther King Jr. Day
+        nth_weekday(year, 2, 0, 3),  # Washington's Birthday
+        easter(year) - timedelta(days=2),  # Good Friday
+        nth_weekday(year, 5, 0, -1),  # Memorial Day
+        observed(date(year, 7, 4)),  # Independence Day
+        nth_weekday(year, 9, 0, 1),  # Labor Day
+        nth_weekday(year, 11, 3, 4),  # Thanksgiving
+        observed(date(year, 12, 25)),  # Christmas
+    }
+    # New Year's Day on a Saturday isn't made up for on the Friday before, as that's the end of the year's accounts
+    if date(year, 1, 1).weekday() != 5:
+        days.add(observed(date(year, 1, 1)))
+    if year >= 2022:
+        days.add(observed(date(year, 6, 19)))  # Juneteenth
+    return frozenset(days)
+
+
+class ExchangeCalendar:
+
+    def __init__(self, config: Config):
+        settings = config.market
+        self.enabled = settings.enabled
+        self.zone = ZoneInfo(settings.timezone)
+        self.open = time.fromisoformat(settings.open)
+        self.close = time.fromisoformat(settings.close)
+        self.days = {DAYS.index(d) for d in settings.days}
+        self.rules = settings.holidays
+        self.closed = {date.fromisoformat(d) for d in settings.closed}
+
+    def __repr__(self):
+        return f"(ExchangeCalendar zone={self.zone}, open={self.open:%H:%M}, close={self.close:%H:%M}, " \
+               f"holidays={self.rules})"
+
+    def applies(self, stocks: Stock) -> bool:
+        """
+        Does the provider keep to trading hours? Stocks do, crypto doesn't, unless [Market] enabled says otherwise.
+        """
+        return stocks.MARKET_HOURS if self.enabled is None else self.enabled
+
+    def trading_day(self, day: date) -> bool:
+        if day.weekday() not in self.days or day in self.closed:
+            return False
+        return not (self.rules == 'nyse' and day in nyse_holidays(day.year))
+
+    def _local(self, now: Optional[datetime]) -> datetime:
+        return datetime.now(self.zone) if now is None else now.astimezone(self.zone)
+
+    def is_open(self, now: Optional[datetime] = None) -> bool:
+        local = self._local(now)
+        return self.trading_day(local.date()) and self.open <= local.time() < self.close
+
+    def last_close(self, now: Optional[datetime] = None) -> datetime:
+        """
+        When the market last closed (before today's session, if it's open).
+        """
+        local = self._local(now)
+        day = local.date()
+        if local.time() < self.close:
+            day -= timedelta(days=1)
+        while not self.trading_day(day):
+            day -= timedelta(days=1)
+        return datetime.combine(day, self.close, tzinfo=self.zone)
+
+    def next_open(self, now: Optional[datetime] = None) -> datetime:
+        local = self._local(now)
+        day = local.date()
+        if local.time() >= self.open:
+            day += timedelta(days=1)
+        while not self.trading_day(day):
+            day += timedelta(days=1)
+        return datetime.combine(day, self.open, tzinfo=self.zone)
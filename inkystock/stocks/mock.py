@@ -14,7 +14,7 @@ class Mock(Stock):
         dates = []
         for d in range(days):
             dates.append(datetime.today() - timedelta(days=d))
-        self.dates = reversed(dates)
+        self.dates = list(reversed(dates))
 
     @staticmethod
     def series(x, m):
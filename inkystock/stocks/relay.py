@@ -0,0 +1,262 @@
+"""
+Sharing provider calls across a fleet of displays on the same network.
+
+Each display asking CoinGecko or IEX for the same prices is a waste of everybody's rate limits and credits. Instead,
+one machine runs the cache server (cache_server.py), which calls the providers on behalf of the others, and the
+displays use the Relay provider to ask it.
+
+The server keeps each answer for a while ([Relay] current_ttl and historical_ttl), and requests for the same thing
+that arrive while it's already asking the provider wait for that answer rather than asking again. Its calls go through
+the scheduler (see scheduler.py), with the quota kept in each upstream config's database, so the server paying for the
+calls stays within the provider's rate limits and monthly credits. When it can't call, the displays get a 429.
+
+Over HTTP:
+
+    GET /current?provider=CoinGecko&crypto=BTC&currency=EUR
+    GET /historical?provider=IEX&stock=AAPL&currency=USD
+
+answer with a Point or a Series as JSON, in the currency asked for.
+"""
+import copy
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import requests
+
+from inkystock.config import Config
+from inkystock.db import Database
+from inkystock.stocks.base import Stock, Point, Series
+from inkystock.stocks.scheduler import QuotaExceeded, Scheduled
+
+log = logging.getLogger("inkystock")
+
+
+class Relay(Stock):
+    """
+    Gets prices from a cache server, which gets them from the [Relay] upstream provider.
+    """
+    # Worth keeping locally too: it saves asking the server on every refresh
+    CACHE_HISTORICAL = True
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        # The server converts to the currency asked for
+        self.PROVIDER_CURRENCY = config.main.currency
+        self.MARKET_HOURS = bool(config.main.stock)
+        self.session = requests.Session()
+        # The server passes on the upstream provider's 429s, so the scheduler backs off here too
+        self.session.hooks['response'].append(self.rate_limited)
+
+    def __repr__(self):
+        return f"(Relay url={self.config.relay.url}, upstream={self.config.relay.upstream})"
+
+    def get(self, path: str) -> requests.Response:
+        params = {'provider': self.config.relay.upstream, 'currency': self.config.main.currency}
+        if len(self.config.main.crypto):
+            params['crypto'] = self.config.main.crypto
+        else:
+            params['stock'] = self.config.main.stock
+        r = self.session.get(f"{self.config.relay.url.rstrip('/')}{path}", params=params,
+                             timeout=self.config.fetch.timeout)
+        r.raise_for_status()
+        return r
+
+    def current(self) -> Point:
+        return Point.parse_raw(self.get("/current").content)
+
+    def historical(self) -> Series:
+        return Series.parse_raw(self.get("/historical").content)
+
+
+class Upstream(Exception):
+    """
+    The upstream provider failed to answer.
+    """
+
+    def __init__(self, message: str, retry_after: float = 0.0):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class PriceCache:
+    """
+    Answers from the upstream providers, kept for a while, with one call at a time for any one answer.
+    """
+    # Providers kept for the assets asked about most recently (each holds a session, and maybe a lookup table)
+    STOCKS_CACHE_SIZE = 64
+
+    def __init__(self, configs: List[Config], make: Callable[[Config], Stock]):
+        """
+        :param configs: one per upstream provider, with its API keys
+        :param make: creates the provider for a config (see main.provider)
+        """
+        self.upstreams = {c.main.provider: c for c in configs}
+        self.make = make
+        settings = configs[0].relay
+        self.ttls = {'current': settings.current_ttl, 'historical': settings.historical_ttl}
+        self._lock = threading.Lock()
+        self._stocks: "OrderedDict[Tuple[str, ...], Scheduled]" = OrderedDict()
+        # The quota is in each upstream's database, and a connection can only be used from the thread it was made on,
+        # so each upstream has a thread of its own for the scheduler (see Scheduled.prepare)
+        self._databases: Dict[str, Database] = {}
+        self._quotas = {name: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"{name}-quota")
+                        for name in self.upstreams}
+        self._answers: Dict[Tuple[str, ...], Tuple[float, bytes]] = {}
+        self._inflight: Dict[Tuple[str, ...], "Future[bytes]"] = {}
+
+    def __repr__(self):
+        return f"(PriceCache upstreams={list(self.upstreams)}, ttls={self.ttls})"
+
+    def quota(self, upstream: str, call: Callable[..., Any], *args) -> Any:
+        """
+        Make a call on the upstream's quota thread, and wait for it.
+        """
+        return self._quotas[upstream].submit(call, *args).result()
+
+    def stocks(self, asset: Tuple[str, str, str, str]) -> Scheduled:
+        """
+        The (scheduled) provider for an (upstream, crypto, stock, currency), created the first time it's asked for.
+        Only called on the upstream's quota thread.
+        """
+        with self._lock:
+            if asset in self._stocks:
+                self._stocks.move_to_end(asset)
+                return self._stocks[asset]
+            upstream, crypto, stock, currency = asset
+            config = copy.copy(self.upstreams[upstream])
+            config.main = config.main.copy(update={'crypto': crypto, 'stock': stock, 'currency': currency})
+            if upstream not in self._databases:
+                self._databases[upstream] = Database(self.upstreams[upstream])
+            self._stocks[asset] = Scheduled(config, self._databases[upstream], self.make(config))
+            while len(self._stocks) > self.STOCKS_CACHE_SIZE:
+                self._stocks.popitem(last=False)
+            return self._stocks[asset]
+
+    def get(self, kind: str, asset: Tuple[str, str, str, str]) -> bytes:
+        """
+        The answer to a current/historical call as JSON, from the cache if it's fresh enough.
+        """
+        if asset[0] not in self.upstreams:
+            raise KeyError(f"No configuration for the {asset[0]} provider")
+        # Historical data is by the day
+        key = (kind, *asset, date.today().isoformat() if kind == 'historical' else "")
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer is not None and answer[0] > time.monotonic():
+                return answer[1]
+            future = self._inflight.get(key)
+            leader = future is None
+            if future is None:
+                future = self._inflight[key] = Future()
+
+        if not leader:
+            log.debug(f"Waiting on the call already made for {key}")
+            return future.result()
+
+        try:
+            try:
+                # Creating the provider can fail too, and is answered the same way as a failed call
+                stocks = self.quota(asset[0], self.stocks, asset)
+                call = self.quota(asset[0], stocks.prepare, kind)
+            except QuotaExceeded as e:
+                # Nothing new can be had before the answer would have expired anyway
+                raise Upstream(f"{asset[0]}: {e}", self.ttls[kind] or 1.0) from e
+            except Exception as e:
+                raise Upstream(f"{asset[0]} failed: {e!r}") from e
+            try:
+                body = call().json().encode('utf-8')
+            except Exception as e:
+                # A 429 holds off every call to the upstream, not just this one
+                self.quota(asset[0], stocks.failed, kind, e)
+                raise Upstream(f"{asset[0]} failed: {e!r}", stocks.stocks.retry_after or 0.0) from e
+            log.info(f"Fetched {kind} for {asset} from {asset[0]}")
+            with self._lock:
+                # Expired answers are dropped as new ones arrive, so yesterday's historical data doesn't pile up
+                now = time.monotonic()
+                for expired in [k for k, (expires, _) in self._answers.items() if expires <= now]:
+                    del self._answers[expired]
+                self._answers[key] = (now + self.ttls[kind], body)
+            future.set_result(body)
+            return body
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    def close(self):
+        for name, quota in self._quotas.items():
+            db = self._databases.get(name)
+            if db is not None:
+                # On the thread the connection was made on, like everything else done with it
+                quota.submit(db.close).result()
+            quota.shutdown()
+
+
+class CacheServer:
+    """
+    Serves a PriceCache over HTTP.
+    """
+
+    def __init__(self, cache: PriceCache, host: str, port: int):
+        self.cache = cache
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                url = urlparse(self.path)
+                kind = url.path.strip("/")
+                params = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if kind not in ('current', 'historical'):
+                    self.send_error(404)
+                    return
+                asset = (params.get('provider', ''), params.get('crypto', ''), params.get('stock', ''),
+                         params.get('currency', ''))
+                try:
+                    body = cache.get(kind, asset)  # type: ignore
+                except KeyError as e:
+                    self.send_error(400, str(e))
+                    return
+                except Upstream as e:
+                    if e.retry_after:
+                        # Passed on, so the displays' schedulers back off too
+                        self.send_response(429)
+                        self.send_header("Retry-After", str(int(e.retry_after) + 1))
+                        self.send_header("Content-Length", "0")
+                        self.end_headers()
+                    else:
+                        self.send_error(502, str(e))
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, fmt, *args):
+                log.debug(f"Cache server: {fmt % args}")
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+
+    def __repr__(self):
+        return f"(CacheServer address={self.address()[0]}:{self.address()[1]}, cache={self.cache})"
+
+    def address(self) -> Tuple[str, int]:
+        return self.server.server_address[:2]  # type: ignore
+
+    def serve_forever(self):
+        log.info(f"Serving prices on http://{self.address()[0]}:{self.address()[1]}/")
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.cache.close()
@@ -0,0 +1,204 @@
+"""
+Keeps calls to the provider within its rate limits and monthly credits.
+
+Free plans are tight: IEX's credits only just cover a refresh every 5 minutes, and CoinGecko's demo key is limited to
+30 calls a minute and 10,000 a month. Going over means errors (or a bill), and a blank display.
+
+The quota is kept in the database, so every process using it (cron runs, the render farm, several displays on one Pi)
+draws from the same budget:
+ - a token bucket for calls per minute: a call waits for a token (up to [Quota] max_wait) or doesn't happen
+ - monthly credits are paced, so they're spent evenly across the month rather than running out on the 20th. Getting
+   ahead of the pace means calls get skipped (cached data is shown instead), which stretches out the refresh interval
+   until the budget catches up.
+ - a Retry-After from the provider stops all calls until it's passed
+
+Updates are optimistic (compare-and-swap on a version number), so nothing needs to hold a lock on the database.
+"""
+import calendar
+import hashlib
+import logging
+import time
+from datetime import datetime
+from typing import Any, Callable, Optional
+
+from sqlalchemy import exc
+from sqlalchemy.sql import select
+
+from inkystock.config import Config
+from inkystock.db import Database
+from inkystock.stocks.base import Stock, Point, Series
+from inkystock.trace import span
+
+log = logging.getLogger("inkystock")
+
+
+class QuotaExceeded(Exception):
+    """
+    The provider can't be called right now without going over its limits. Show cached data instead.
+    """
+
+
+class Scheduler:
+
+    # Attempts at the compare-and-swap before assuming something's wrong
+    ATTEMPTS = 10
+
+    def __init__(self, config: Config, db: Database, stocks: Stock):
+        self.config = config
+        self.db = db
+        self.stocks = stocks
+
+        quota = config.quota
+        self.calls_per_minute = stocks.CALLS_PER_MINUTE if quota.calls_per_minute is None else quota.calls_per_minute
+        self.monthly_credits = stocks.MONTHLY_CREDITS if quota.monthly_credits is None else quota.monthly_credits
+        self.max_wait = quota.max_wait
+
+        # Each API key has its own quota
+        m = hashlib.sha1()
+        m.update(config.iex.token.encode('utf-8'))
+        m.update(config.coingecko.api_key.encode('utf-8'))
+        self.key = f"{config.main.provider}:{m.hexdigest()[:12]}"
+
+    def __repr__(self):
+        return f"(Scheduler key={self.key}, calls_per_minute={self.calls_per_minute}, " \
+               f"monthly_credits={self.monthly_credits})"
+
+    @staticmethod
+    def month_progress(now: datetime) -> float:
+        """
+        How far through the month we are, from 0 to 1.
+        """
+        days = calendar.monthrange(now.year, now.month)[1]
+        elapsed = (now - now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)).total_seconds()
+        return elapsed / (days * 24 * 60 * 60)
+
+    def allowance(self, now: datetime) -> float:
+        """
+        Credits that can have been spent by now this month. There's a day's worth of slack, so the first refresh of
+        the month (or a daily historical fetch) isn't held up.
+        """
+        days = calendar.monthrange(now.year, now.month)[1]
+        return self.monthly_credits * (self.month_progress(now) + 1 / days)
+
+    def _row(self):
+        s = select([self.db.quotas]).where(self.db.quotas.c.key == self.key)
+        row = self.db.conn.execute(s).first()
+        if row is None:
+            try:
+                self.db.conn.execute(self.db.quotas.insert().values(
+                    key=self.key, tokens=float(self.calls_per_minute), updated=time.time(),
+                    month=datetime.now().strftime("%Y-%m"), credits=0, retry_at=0.0, version=0))
+            except exc.IntegrityError:
+                # Another process got there first
+                pass
+            row = self.db.conn.execute(s).first()
+        return row
+
+    def acquire(self, cost: int = 1):
+        """
+        Take a token (waiting for one if it's not too long) and spend `cost` credits, or raise QuotaExceeded.
+        """
+        with span("provider.quota"):
+            for _ in range(self.ATTEMPTS):
+                row = self._row()
+                now = datetime.now()
+                timestamp = time.time()
+
+                if row.retry_at > timestamp:
+                    raise QuotaExceeded(f"{self.config.main.provider} asked for no calls until "
+                                        f"{datetime.fromtimestamp(row.retry_at):%H:%M:%S}")
+
+                credits = row.credits if row.month == now.strftime("%Y-%m") else 0
+                if self.monthly_credits and credits + cost > self.allowance(now):
+                    raise QuotaExceeded(f"{self.config.main.provider} has used {credits} of {self.monthly_credits} "
+                                        f"monthly credits, ahead of pace; stretching the refresh interval")
+
+                tokens = 1.0
+                if self.calls_per_minute:
+                    rate = self.calls_per_minute / 60
+                    tokens = min(float(self.calls_per_minute), row.tokens + (timestamp - row.updated) * rate)
+                    if tokens < 1:
+                        wait = (1 - tokens) / rate
+                        if wait > self.max_wait:
+                            raise QuotaExceeded(f"{self.config.main.provider} rate limit needs a {wait:.0f}s wait")
+                        log.info(f"Waiting {wait:.1f}s for the {self.config.main.provider} rate limit")
+                        time.sleep(wait)
+                        continue
+
+                update = self.db.quotas.update() \
+                    .where(self.db.quotas.c.key == self.key) \
+                    .where(self.db.quotas.c.version == row.version) \
+                    .values(tokens=tokens - 1, updated=timestamp, month=now.strftime("%Y-%m"),
+                            credits=credits + cost, version=row.version + 1)
+                if self.db.conn.execute(update).rowcount == 1:
+                    log.debug(f"{self}: {credits + cost} credits used this month")
+                    return
+                # Another process updated the quota in the meantime, so go again with its numbers
+            raise QuotaExceeded(f"Couldn't update the quota for {self.key}")
+
+    def backoff(self, seconds: float):
+        """
+        Hold off every process on calling the provider for a while.
+        """
+        row = self._row()
+        retry_at = max(row.retry_at, time.time() + seconds)
+        self.db.conn.execute(self.db.quotas.update()
+                             .where(self.db.quotas.c.key == self.key)
+                             .values(retry_at=retry_at, version=row.version + 1))
+
+
+class Scheduled(Stock):
+    """
+    Wraps a provider so that every call goes through the scheduler.
+    """
+
+    def __init__(self, config: Config, db: Database, stocks: Stock):
+        # Not calling super().__init__, there's nothing to convert; the wrapped provider does that
+        self.config = config
+        self.stocks = stocks
+        self.scheduler = Scheduler(config, db, stocks)
+        self.PROVIDER_CURRENCY = stocks.PROVIDER_CURRENCY
+        self.CACHE_HISTORICAL = stocks.CACHE_HISTORICAL
+        self.MARKET_HOURS = stocks.MARKET_HOURS
+        self.retry_after: Optional[float] = None
+
+    def __repr__(self):
+        return f"(Scheduled stocks={self.stocks.__class__.__name__}, scheduler={self.scheduler})"
+
+    def cost(self, name: str) -> int:
+        return self.stocks.cost(name)
+
+    def prepare(self, name: str) -> Callable[[], Any]:
+        """
+        Take a call's credits now, and hand back the provider's call to make later. For calls made on another thread:
+        the quota is in the database, and the connection can't be used from any thread but the one it was made on.
+        """
+        self.scheduler.acquire(self.stocks.cost(name))
+        # Only a 429 from this call counts in failed(), not one from some earlier call
+        self.stocks.retry_after = None
+        return getattr(self.stocks, name)
+
+    def failed(self, name: str, error: Exception) -> Exception:
+        """
+        What a failed call amounts to: if the provider rate limited it, every process backs off and it's QuotaExceeded.
+        """
+        if self.stocks.retry_after is not None:
+            self.scheduler.backoff(self.stocks.retry_after)
+            return QuotaExceeded(f"{self.config.main.provider} rate limited the {name} call")
+        return error
+
+    def _call(self, name: str):
+        call = self.prepare(name)
+        try:
+            return call()
+        except Exception as e:
+            error = self.failed(name, e)
+            if error is e:
+                raise
+            raise error from e
+
+    def current(self) -> Point:
+        return self._call('current')
+
+    def historical(self) -> Series:
+        return self._call('historical')
@@ -0,0 +1,157 @@
+"""
+Streaming prices: a push feed instead of polling the provider's REST API every few minutes.
+
+The feed is a TCP socket sending one JSON object per line:
+
+    {"asset": "BTC", "currency": "EUR", "price": 12345.67, "timestamp": 1700000000.0}
+
+asset and currency are optional (messages for other assets/currencies are skipped), as is timestamp (the time it
+arrives is used instead). Most exchange websocket tickers can be bridged to this with a few lines of glue.
+
+FakeFeed serves a random walk in this format, for trying things out without an exchange.
+"""
+import json
+import logging
+import queue
+import random
+import socket
+import socketserver
+import threading
+import time
+from datetime import datetime
+from typing import Iterator, Optional, Tuple
+
+from inkystock.config import Config
+from inkystock.stocks.base import Point, Streaming
+
+log = logging.getLogger("inkystock")
+
+
+class LineFeed(Streaming):
+    """
+    Reads line-delimited JSON prices from a TCP socket.
+    """
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self.address = (config.stream.host, config.stream.port)
+        self.asset = config.main.crypto if len(config.main.crypto) else config.main.stock
+        self._sock: Optional[socket.socket] = None
+
+    def __repr__(self):
+        return f"(LineFeed address={self.address[0]}:{self.address[1]}, asset={self.asset})"
+
+    def parse(self, line: str) -> Optional[Point]:
+        try:
+            message = json.loads(line)
+            if message.get('asset', self.asset).upper() != self.asset.upper():
+                return None
+            if message.get('currency', self.config.main.currency).upper() != self.config.main.currency.upper():
+                return None
+            timestamp = datetime.fromtimestamp(message['timestamp']) if 'timestamp' in message else datetime.now()
+            return Point(timestamp=timestamp, data=float(message['price']))
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            log.warning(f"Skipping unreadable message from {self}: {e!r}")
+            return None
+
+    def ticks(self) -> Iterator[Point]:
+        self._sock = socket.create_connection(self.address, timeout=self.config.fetch.timeout)
+        # Quiet feeds are fine; only connecting has a timeout
+        self._sock.settimeout(None)
+        log.info(f"Connected to {self}")
+        with self._sock, self._sock.makefile('r', encoding='utf-8') as lines:
+            for line in lines:
+                point = self.parse(line)
+                if point is not None:
+                    yield point
+        log.warning(f"{self} closed the connection")
+
+    def close(self):
+        if self._sock is not None:
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class Stream:
+    """
+    Reads a feed on a background thread (reconnecting as needed), handing prices over through a queue, so the
+    consumer can keep to its own schedule (and keep the database on its own thread).
+    """
+
+    # Seconds between reconnection attempts, doubling up to the maximum
+    RECONNECT = 1.0
+    RECONNECT_MAX = 60.0
+
+    def __init__(self, feed: Streaming):
+        self.feed = feed
+        self.queue: "queue.Queue[Point]" = queue.Queue()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stream", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        delay = self.RECONNECT
+        while not self._stopped.is_set():
+            try:
+                for point in self.feed.ticks():
+                    self.queue.put(point)
+                    delay = self.RECONNECT
+            except Exception as e:
+                if self._stopped.is_set():
+                    return
+                log.warning(f"{self.feed} failed: {e!r}, reconnecting in {delay:.0f}s")
+            self._stopped.wait(delay)
+            delay = min(delay * 2, self.RECONNECT_MAX)
+
+    def get(self, timeout: float) -> Optional[Point]:
+        """
+        The next price, or None if nothing arrived within the timeout.
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._stopped.set()
+        self.feed.close()
+
+
+class FakeFeed:
+    """
+    Serves a random walk as a line-delimited JSON feed, to every client that connects.
+    """
+
+    def __init__(self, config: Config, interval: float = 1.0, start: float = 100.0, volatility: float = 0.002):
+        asset = config.main.crypto if len(config.main.crypto) else config.main.stock
+        currency = config.main.currency
+        feed = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                price = start
+                while not feed.stopped.is_set():
+                    price *= 1 + random.gauss(0, volatility)
+                    message = {"asset": asset, "currency": currency, "price": round(price, 2), "timestamp": time.time()}
+                    try:
+                        self.wfile.write((json.dumps(message) + "\n").encode('utf-8'))
+                    except OSError:
+                        return
+                    feed.stopped.wait(interval)
+
+        self.stopped = threading.Event()
+        self.server = socketserver.ThreadingTCPServer((config.stream.host, config.stream.port), Handler)
+        self.server.daemon_threads = True
+        self._thread = threading.Thread(target=self.server.serve_forever, name="fake-feed", daemon=True)
+        self._thread.start()
+        log.info(f"Serving a fake {asset}/{currency} feed on {self.address()[0]}:{self.address()[1]}")
+
+    def address(self) -> Tuple[str, int]:
+        return self.server.server_address[:2]  # type: ignore
+
+    def close(self):
+        self.stopped.set()
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,192 @@
+"""
+Lightweight timing of the refresh pipeline, so it's possible to see where the time goes on a Pi Zero.
+
+Stages are wrapped in (nested) spans:
+
+    with span("fetch"):
+        ...
+
+or, for functions/methods that are always worth timing:
+
+    @traced("chart.render")
+    def render(self):
+        ...
+
+At the end of a run the spans can be exported as a JSON record, or in the Prometheus text format (e.g., for the
+node_exporter textfile collector).
+"""
+import functools
+import json
+import logging
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+log = logging.getLogger("inkystock")
+
+
+class Span:
+
+    def __init__(self, name: str, parent: Optional["Span"] = None):
+        self.name = name
+        self.parent = parent
+        self.children: List["Span"] = []
+        self.timestamp = time.time()
+        self.duration = 0.0
+        # CPU time is for the whole process, so includes any other threads that were busy during the span
+        self.cpu = 0.0
+        # Peak resident set size of the process (in KiB) as of the end of the span
+        self.rss = 0
+        self._start = time.perf_counter()
+        self._cpu_start = time.process_time()
+
+    def __repr__(self):
+        return f"(Span name={self.name}, duration={self.duration:.4f})"
+
+    def finish(self):
+        self.duration = time.perf_counter() - self._start
+        self.cpu = time.process_time() - self._cpu_start
+        self.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def record(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "timestamp": self.timestamp,
+            "duration": self.duration,
+            "cpu": self.cpu,
+            "rss": self.rss,
+            "children": [c.record() for c in self.children],
+        }
+
+
+class Tracer:
+    """
+    Collects spans. Each thread has its own stack of open spans; a span opened on a thread with nothing open (e.g., a
+    background worker) is attached to whichever top level span is running, so the whole run ends up in one tree.
+    """
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._root: Optional[Span] = None
+
+    def _stack(self) -> List[Span]:
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    def reset(self):
+        with self._lock:
+            self.spans = []
+            self._root = None
+
+    @contextmanager
+    def span(self, name: str) -> Iterator[Span]:
+        stack = self._stack()
+        with self._lock:
+            parent = stack[-1] if stack else self._root
+            s = Span(name, parent)
+            if parent is None:
+                self.spans.append(s)
+                self._root = s
+            else:
+                parent.children.append(s)
+        stack.append(s)
+        try:
+            yield s
+        finally:
+            s.finish()
+            stack.pop()
+            with self._lock:
+                if self._root is s:
+                    self._root = None
+
+    def traced(self, name: str) -> Callable:
+        """
+        Decorator version of span()
+        """
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def record(self) -> Dict[str, Any]:
+        return {"timestamp": time.time(), "spans": [s.record() for s in self.spans]}
+
+    def stages(self) -> Dict[str, Dict[str, float]]:
+        """
+        Totals per span name. Spans nested inside a span of the same name (e.g., painting nested containers) count as
+        calls, but their time is already included in the outer one.
+        """
+        totals: Dict[str, Dict[str, float]] = {}
+
+        def walk(s: Span, open_names: frozenset):
+            stage = totals.setdefault(s.name, {"seconds": 0.0, "cpu": 0.0, "rss": 0, "calls": 0})
+            stage["calls"] += 1
+            stage["rss"] = max(stage["rss"], s.rss)
+            if s.name not in open_names:
+                stage["seconds"] += s.duration
+                stage["cpu"] += s.cpu
+            for child in s.children:
+                walk(child, open_names | {s.name})
+
+        for s in self.spans:
+            walk(s, frozenset())
+        return totals
+
+    def prometheus(self) -> str:
+        lines = [
+            "# HELP inkystock_stage_duration_seconds Time spent in each stage of the last refresh.",
+            "# TYPE inkystock_stage_duration_seconds gauge",
+        ]
+        stages = self.stages()
+        for name, stage in stages.items():
+            lines.append(f'inkystock_stage_duration_seconds{{stage="{name}"}} {stage["seconds"]:.6f}')
+        lines += [
+            "# HELP inkystock_stage_calls Number of times each stage ran in the last refresh.",
+            "# TYPE inkystock_stage_calls gauge",
+        ]
+        for name, stage in stages.items():
+            lines.append(f'inkystock_stage_calls{{stage="{name}"}} {int(stage["calls"])}')
+        lines += [
+            "# HELP inkystock_last_refresh_timestamp_seconds When the last refresh finished.",
+            "# TYPE inkystock_last_refresh_timestamp_seconds gauge",
+            f"inkystock_last_refresh_timestamp_seconds {time.time():.3f}",
+        ]
+        return "\n".join(lines) + "\n"
+
+    def export(self, json_path: str = "", prometheus_path: str = ""):
+        """
+        Append the run as a line of JSON, and/or replace a Prometheus textfile. Empty paths are skipped.
+        """
+        # Metrics are a side show: a path that can't be written mustn't stop the display refreshing
+        if json_path:
+            try:
+                with open(json_path, "a") as f:
+                    f.write(json.dumps(self.record()) + "\n")
+            except OSError as e:
+                log.warning(f"Couldn't write the metrics to {json_path}: {e}")
+        if prometheus_path:
+            try:
+                # The textfile collector may read at any time, so never let it see a partial file
+                with open(f"{prometheus_path}.tmp", "w") as f:
+                    f.write(self.prometheus())
+                os.replace(f"{prometheus_path}.tmp", prometheus_path)
+            except OSError as e:
+                log.warning(f"Couldn't write the metrics to {prometheus_path}: {e}")
+
+    def summary(self) -> str:
+        return ", ".join(f"{name}: {stage['seconds']:.3f}s" for name, stage in self.stages().items())
+
+
+# A single tracer for the process, with module level shortcuts
+tracer = Tracer()
+span = tracer.span
+traced = tracer.traced
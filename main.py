@@ -1,16 +1,35 @@
+import json
 import logging
 import argparse
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from typing import Optional, Tuple
 
+from inkystock.atlas import compile_fonts
+from inkystock.cadence import next_interval
+from inkystock.chart import ChartMode
 from inkystock.config import Config
-from inkystock.db import Database
-from inkystock.layout import Container, Layout
-from inkystock.paint import Pillow
+from inkystock.db import Database, FillInProgress
+from inkystock.layout import Container, Layout, LayoutList, describe
+from inkystock.lock import RunLock, coalesced
+from inkystock.outputs import CONTENT, Outputs, content_digest
+from inkystock.paint import Pillow, PillowImage
+from inkystock.profiling import profiled
+from inkystock.stocks.base import Stock, Point, Series
 from inkystock.stocks.coingecko import CoinGecko
+from inkystock.stocks.fetch import Fetch
 from inkystock.stocks.iex import IEX
+from inkystock.stocks.market import ExchangeCalendar
 from inkystock.stocks.mock import Mock
+from inkystock.stocks.relay import Relay
+from inkystock.stocks.scheduler import QuotaExceeded, Scheduled
+from inkystock.trace import span, tracer
 
 from ui import StatusBar, TickerBar, Headline, Chart
 
+log = logging.getLogger("inkystock")
+
 
 def setup_logging(level: str) -> logging.Logger:
     logging.basicConfig(
@@ -20,81 +39,184 @@ def setup_logging(level: str) -> logging.Logger:
     return log
 
 
-def main():
-    # Pull in expected environment variables for replacement in config.ini
-    # Need to do this otherwise variable interpolation breaks on the Pi due to some funky stuff in LS_COLORS
-    # There may be other weird stuff set, so safer just to use an allow-list.
-    env_vars = [
-        'IEX_TOKEN',
-        'IEX_ENDPOINT',
-        'INKYSTOCK_SCREEN',
-        'INKYSTOCK_DATABASE',
-    ]
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--config", default="config.ini")
-    args = parser.parse_args()
-
-    config = Config(env_vars=env_vars, path=args.config)
-
-    log = setup_logging(config.main.loglevel)
+# Pull in expected environment variables for replacement in config.ini
+# Need to do this otherwise variable interpolation breaks on the Pi due to some funky stuff in LS_COLORS
+# There may be other weird stuff set, so safer just to use an allow-list.
+ENV_VARS = [
+    'IEX_TOKEN',
+    'IEX_ENDPOINT',
+    'INKYSTOCK_SCREEN',
+    'INKYSTOCK_DATABASE',
+]
 
-    log.info(f"Configured resolution: {config.main.display_width_pixels}x{config.main.display_height_pixels}")
-    log.info(f"Configured color: {config.main.color}")
-
-    db = Database(config)
 
+def provider(config: Config) -> Stock:
     if config.main.provider == 'IEX':
-        stocks = IEX(config)
+        return IEX(config)
     elif config.main.provider == 'CoinGecko':
-        stocks = CoinGecko(config)
+        return CoinGecko(config)
     elif config.main.provider == 'MOCK':
-        stocks = Mock(config)
+        return Mock(config)
+    elif config.main.provider == 'Relay':
+        return Relay(config)
     else:
         raise NotImplementedError(f"There is no stock provider available for {config.main.provider}")
 
-    log.info("Pulling current data from API and caching")
-    current = db.store_current(stocks.current())
 
+def fetch_key(config: Config) -> Tuple[str, ...]:
+    """
+    Configs with the same key get the same answer from the provider, so only one of them needs to ask.
+    """
+    return (config.main.provider,
+            config.main.crypto,
+            config.main.stock,
+            config.main.currency,
+            config.iex.token,
+            str(config.iex.endpoint),
+            config.coingecko.api_key)
+
+
+def stale_historical(db: Database, days: int = 7) -> Series:
+    """
+    The most recent historical data cached in the last few days, for when the provider can't be asked for today's.
+    """
+    for days_ago in range(1, days + 1):
+        try:
+            return db.retrieve_historical(date.today() - timedelta(days=days_ago))
+        except LookupError:
+            continue
+    raise LookupError(f"No historical data cached in the last {days} days")
+
+
+def historical_data(db: Database, stocks: Stock) -> Series:
     if stocks.CACHE_HISTORICAL:
-        log.info("Pulling historical data from API and caching")
+        def fill() -> str:
+            log.info("Pulling historical data from API and caching")
+            with span("provider.historical"):
+                return stocks.historical().json()
+
+        # Once a day, everything sharing the database misses the cache at once; only one of them calls the provider
         try:
-            historical = db.retrieve_historical()
+            return Series.parse_raw(db.cached(db.cache_key(), fill))
+        except (QuotaExceeded, FillInProgress) as e:
+            log.warning(f"{e}, showing older historical data")
+            return stale_historical(db)
         except Exception as e:
-            log.warning(e)
-            historical = db.store_historical(stocks.historical())
+            # The provider (or the database) failing is no reason to show nothing, if there's older data cached
+            log.exception(f"Couldn't get today's historical data, showing older historical data: {e}")
+            return stale_historical(db)
     else:
         log.info("Pulling historical data from API")
-        historical = stocks.historical()
+        with span("provider.historical"):
+            return stocks.historical()
 
-    recent = db.recent()
 
-    # the painter is responsible for turning the layout we're specifying into pixels
-    painter = Pillow(config)
+def current_data(config: Config, db: Database, stocks: Stock) -> Tuple[Point, bool, Optional[Fetch[Point]]]:
+    """
+    The current price, fresh from the provider if it answers within the latency budget. Otherwise it's the last stored
+    price, flagged as stale, along with the fetch if it's still going (see revalidate).
+    """
+    fetch: Optional[Fetch[Point]] = None
+    try:
+        # The quota is taken here rather than on the fetch's thread, as it's kept in the database
+        call = stocks.prepare('current') if isinstance(stocks, Scheduled) else stocks.current
+        fetch = Fetch(call, name="provider.current")
+        with span("provider.current"):
+            return db.store_current(fetch.result(config.fetch.budget)), False, None
+    except Exception as e:
+        error = e
+
+    pending = fetch if fetch is not None and not fetch.done() else None
+    if fetch is not None and pending is None and isinstance(stocks, Scheduled):
+        error = stocks.failed('current', error)
+    try:
+        current = db.latest()
+    except LookupError:
+        if pending is None:
+            raise error
+        # Nothing stored to fall back on (e.g., the first run), so there's no choice but to wait
+        log.warning(f"{config.main.provider} is slow, and there's no stored price to show instead")
+        with span("provider.current"):
+            return db.store_current(pending.result(config.fetch.timeout)), False, None
+
+    if pending is None:
+        log.warning(f"{error!r}, showing the last stored price")
+    else:
+        log.warning(f"No answer from {config.main.provider} within {config.fetch.budget}s, "
+                    f"showing the last stored price")
+    return current, True, pending
 
-    # The details (elements, layout, etc) of UI components are specified in ui.py.
-    # This hopefully makes the relationship between the data and its layout clearer.
-    status_bar = StatusBar(config, painter).build()
 
-    # The latest price is pulled and stored with a timestamp on each invocation of the application.
-    # Here, it's formatted as a list of floats in reverse order so it can be displayed as a price ticker.
-    ticks = [r.data for r in recent.series]
-    ticker_bar = TickerBar(config, painter, [f"{tick:.2f}" for tick in reversed(ticks)]).build()
+def revalidate(config: Config, db: Database, stocks: Stock, pending: Fetch[Point]):
+    """
+    Give a slow provider the rest of its timeout to answer, and store the price for the next refresh.
+    """
+    with span("provider.revalidate"):
+        try:
+            point = pending.result(config.fetch.timeout)
+        except Exception as e:
+            if isinstance(stocks, Scheduled):
+                e = stocks.failed('current', e)
+            log.warning(f"Giving up on {config.main.provider}: {e!r}")
+            return
+    db.store_current(point)
+    log.info(f"Stored a late price from {config.main.provider} for the next refresh")
 
-    # The most recent price is compared to yesterday's close to determine the price change.
-    # That feeds into the arrow orientation, as well as which mascot gets picked to go alongside the price.
-    # The most recent price is set as the "headline" price.
-    most_recent = ticks[0]
-    yesterday = [h.data for h in reversed(historical.series)][0]
-    asset = config.main.crypto if len(config.main.crypto) else config.main.stock
-    log.info(f"Most recent price in {config.main.currency} for {asset}: {most_recent} (last close: {yesterday})")
 
-    change = most_recent - yesterday
+def chart_data(config: Config, db: Database, historical: Series) -> Series:
+    """
+    The series the chart plots: the daily history, or (in intraday mode) the prices stored on every refresh, which
+    doesn't cost any extra calls to the provider.
+    """
+    if config.chart.mode == ChartMode.INTRADAY:
+        return db.intraday(config.chart.hours, config.chart.bucket_minutes)
+    return historical
 
-    headline = Headline(config, painter, current.data, change).build()
 
+def build_chart(config: Config, painter: Pillow, historical: Series) -> Container:
     # The chart plots a timeseries. It's difficult to get too much detail at the low resolution of an InkyPHAT, so
     # this is most useful for large trends.
-    chart = Chart(config, painter, historical).build()
+    with span("build.chart"):
+        return Chart(config, painter, historical).build()
+
+
+def render(config: Config, painter: Pillow, current: Point, historical: Series, recent: Series,
+           chart: Optional["Future[Container]"] = None, plotted: Optional[Series] = None,
+           stale: bool = False) -> PillowImage:
+    """
+    Turn the data into a painted frame, ready for the outputs.
+    :param chart: the chart section, if it's already being built elsewhere
+    :param plotted: the series to chart, if not the historical data (see chart_data)
+    :param stale: the current price couldn't be refreshed
+    """
+    pool = None
+    if chart is None:
+        # Rasterizing the chart (matplotlib) is the slowest part of building the UI by a distance, and it's independent
+        # of the other sections, so build it in the background while the rest are built.
+        pool = ThreadPoolExecutor(max_workers=1)
+        chart = pool.submit(build_chart, config, painter, historical if plotted is None else plotted)
+
+    # The details (elements, layout, etc) of UI components are specified in ui.py.
+    # This hopefully makes the relationship between the data and its layout clearer.
+    with span("build"):
+        status_bar = StatusBar(config, painter, stale=current.timestamp if stale else None).build()
+
+        # The latest price is pulled and stored with a timestamp on each invocation of the application.
+        # Here, it's formatted as a list of floats in reverse order so it can be displayed as a price ticker.
+        ticks = [r.data for r in recent.series]
+        ticker_bar = TickerBar(config, painter, [f"{tick:.2f}" for tick in reversed(ticks)]).build()
+
+        # The most recent price is compared to yesterday's close to determine the price change.
+        # That feeds into the arrow orientation, as well as which mascot gets picked to go alongside the price.
+        # The most recent price is set as the "headline" price.
+        most_recent = ticks[0]
+        yesterday = [h.data for h in reversed(historical.series)][0]
+        asset = config.main.crypto if len(config.main.crypto) else config.main.stock
+        log.info(f"Most recent price in {config.main.currency} for {asset}: {most_recent} (last close: {yesterday})")
+
+        change = most_recent - yesterday
+
+        headline = Headline(config, painter, current.data, change).build()
 
     # The layout is assembled by combining the containers in order from top to bottom and left to right, depending on
     # the <display> configuration.
@@ -102,24 +224,199 @@ def main():
     root.add(status_bar)
     root.add(ticker_bar)
     root.add(headline)
-    root.add(chart)
+    # Wait for the chart to be ready before working out the layout
+    with span("build.wait"):
+        root.add(chart.result())
+    if pool is not None:
+        pool.shutdown()
 
     # The physical pixel dimensions are calculated in the layout step
-    layout = Layout(root).layout()
+    with span("layout"):
+        layout = Layout(root).layout()
+    if config.metrics.layout_path:
+        dump_layout(config.metrics.layout_path, layout)
     # An image object is created based on the layout
     size = (config.main.display_width_pixels, config.main.display_height_pixels)
     image = painter.paint(size, layout)
     # Rotate the image if configured
     if config.main.rotate_display:
         image.rotate(config.main.rotate_display)
-    # The resulting image is saved locally for optional inspection
-    image.render().save(config.outputs.local)
-
-    # The image is then rendered to the display. The InkyPHAT display has an idiosyncratic palette; inverting normal
-    # black and white is enough to have it render correctly, and it's more convenient to do at this point, so that the
-    # intermediate images can be rendered and viewed normally.
-    if config.outputs.screen == "inky":
-        painter.display(image)
+    # So the outputs can tell whether anything's changed, without the status bar's clock getting in the way
+    charted = historical if plotted is None else plotted
+    image.image.info[CONTENT] = content_digest(config.main.color, asset, config.main.currency, current.data,
+                                               current.timestamp if stale else None, ticks, charted.series)
+    return image
+
+
+def dump_layout(path: str, layout: LayoutList):
+    """
+    Write the layout out as a JSON tree (see [Metrics] layout_path in config.ini).
+    """
+    try:
+        with open(path, "w") as f:
+            json.dump(describe(layout), f, indent=2)
+    except OSError as e:
+        log.warning(f"Couldn't write the layout to {path}: {e}")
+
+
+def refresh(config: Config, db: Optional[Database] = None, stocks: Optional[Stock] = None,
+            painter: Optional[Pillow] = None, outputs: Optional[Outputs] = None) -> float:
+    """
+    One full update: pull the data, store it, render it, and send it to the outputs.
+    The database, provider and painter are created from the configuration unless they're handed in (e.g., by bench.py)
+    Outputs that are handed in are left running: the refresh returns as soon as the frame is handed over, without
+    waiting on the panel.
+    :return: seconds until the next refresh is due (see [Schedule] in config.ini)
+    """
+    if db is None:
+        with span("db.connect"):
+            db = Database(config)
+
+    if stocks is None:
+        stocks = Scheduled(config, db, provider(config))
+
+    market = ExchangeCalendar(config)
+    if market.applies(stocks) and not market.is_open():
+        # Once the close is stored (and so on the display), there's nothing new until the market opens again
+        try:
+            latest: Optional[Point] = db.latest()
+        except LookupError:
+            latest = None
+        closed = market.last_close()
+        # Stored prices are in local time
+        if latest is not None and latest.timestamp >= closed.astimezone().replace(tzinfo=None):
+            opens = market.next_open()
+            log.info(f"The market is closed until {opens:%a %H:%M %Z}, already showing the close ({latest.data})")
+            return (opens - datetime.now(opens.tzinfo)).total_seconds()
+
+    # the painter is responsible for turning the layout we're specifying into pixels
+    if painter is None:
+        painter = Pillow(config)
+
+    historical = historical_data(db, stocks)
+    # Queried up front, since the database connection can't be shared with the chart's thread. In intraday mode, that
+    # means the chart runs up to the previous refresh.
+    plotted = chart_data(config, db, historical)
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        # The chart only needs the historical data (usually cached), so it can be rasterized in the background while
+        # the current price is fetched from the API, and the rest of the UI is built.
+        chart = pool.submit(build_chart, config, painter, plotted)
+
+        log.info("Pulling current data from API and caching")
+        current, stale, pending = current_data(config, db, stocks)
+
+        recent = db.recent()
+
+        image = render(config, painter, current, historical, recent, chart, plotted=plotted, stale=stale)
+
+    # The image is then handed to each of the configured outputs: the display itself, a snapshot saved locally for
+    # optional inspection, etc. Each one runs in the background, so the display doesn't have to wait on the SD card.
+    # The InkyPHAT display has an idiosyncratic palette; inverting normal black and white is enough to have it render
+    # correctly, and it's more convenient to do at this point, so that the intermediate images can be rendered and
+    # viewed normally.
+    with span("outputs"):
+        if outputs is None:
+            outputs = Outputs(config, painter)
+            outputs.publish(image)
+            outputs.close()
+        else:
+            outputs.publish(image)
+
+    # Only once the display's been updated: if the provider was slow, it's had the whole refresh to answer
+    if pending is not None:
+        revalidate(config, db, stocks, pending)
+
+    return next_interval(config, db)
+
+
+# Seconds early a run can start and still count as due
+DUE_SLACK = 30
+
+
+def loop(config: Config):
+    """
+    Refresh every [Schedule] interval (or adaptively), in one long-running process instead of from cron. The database,
+    provider, board and outputs are kept between refreshes, and the panel refreshes in the background: while it's busy,
+    the next frame is already being fetched and rendered (and if it's still busy when that's done, only the newest frame
+    is shown).
+    """
+    db = Database(config)
+    stocks = Scheduled(config, db, provider(config))
+    painter = Pillow(config)
+    outputs = Outputs(config, painter)
+    try:
+        while True:
+            started = time.monotonic()
+            interval = config.schedule.interval
+            tracer.reset()
+            with span("run"):
+                try:
+                    interval = refresh(config, db, stocks, painter, outputs)
+                except Exception as e:
+                    # Try again next time, rather than leaving the display to go stale
+                    log.exception(f"Refresh failed: {e}")
+            log.info(f"Timings: {tracer.summary()}")
+            tracer.export(config.metrics.json_path, config.metrics.prometheus)
+            time.sleep(max(0.0, interval - (time.monotonic() - started)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        outputs.close(config.fetch.timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.ini")
+    parser.add_argument("--profile", action="store_true", help="profile this refresh (see [Profiling] in config.ini)")
+    parser.add_argument("--loop", action="store_true", help="keep running, refreshing every [Schedule] interval")
+    parser.add_argument("--atlas", action="store_true", help="compile the fonts' glyph atlases (see [Fonts] atlas)")
+    parser.add_argument("--dump-layout", metavar="PATH", help="write the layout to PATH as JSON (see [Metrics])")
+    args = parser.parse_args()
+
+    with span("config"):
+        config = Config(env_vars=ENV_VARS, path=args.config, snapshot=True)
+
+    setup_logging(config.main.loglevel)
+    if args.dump_layout:
+        config.metrics = config.metrics.copy(update={'layout_path': args.dump_layout})
+
+    log.info(f"Configured resolution: {config.main.display_width_pixels}x{config.main.display_height_pixels}")
+    log.info(f"Configured color: {config.main.color}")
+
+    if args.atlas:
+        for font, size, glyphs in compile_fonts(config):
+            log.info(f"{font} at {size}: {glyphs or 'drawn by FreeType'}")
+        return
+
+    if args.loop:
+        loop(config)
+        return
+
+    lock = RunLock(config.schedule.lock, config.schedule.overlap)
+    due = lock.due()
+    # cron only starts runs on the minute, so a run that's due within the next DUE_SLACK seconds goes ahead now
+    if config.schedule.adaptive and due is not None and time.time() < due - DUE_SLACK:
+        log.info(f"The next refresh isn't due until {datetime.fromtimestamp(due):%H:%M:%S} (adaptive schedule)")
+        return
+
+    def run() -> float:
+        # Everything is timed, so it's possible to see where a refresh spends its time (see [Metrics] in config.ini)
+        with span("run"):
+            if args.profile or config.profiling.enabled:
+                with profiled(config.profiling.directory, config.profiling.keep, config.profiling.top):
+                    interval = refresh(config)
+            else:
+                interval = refresh(config)
+
+        log.info(f"Timings: {tracer.summary()}")
+        tracer.export(config.metrics.json_path, config.metrics.prometheus)
+        # A follow-up run gets its own timings
+        tracer.reset()
+        return interval
+
+    # Only one run at a time; overlapping runs from cron coalesce into a follow-up (see [Schedule] in config.ini)
+    coalesced(lock, run, config.schedule.interval)
 
 
 if '__main__' == __name__:
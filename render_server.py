@@ -0,0 +1,225 @@
+"""
+Render server: frames on demand over HTTP, for previews and dashboards, without a panel or the cron job.
+
+    python render_server.py config.ini [iex.ini ...]
+
+    GET /frame.png?crypto=BTC&currency=EUR&width=250&height=122&color=red
+    GET /frame.bin?stock=AAPL&currency=USD&provider=IEX&width=212&height=104&color=black
+
+Frames are rendered by the same pipeline as main.py, in a pool of worker processes. Prices come from the providers
+through the same cache as cache_server.py (one config per provider, for its API keys), and the ticker bar shows the
+prices the server has seen for the asset. Recent frames are kept, keyed by the data that went into them and the
+geometry, so a dashboard polling the same frame only pays for a render when the price changes.
+
+/frame.bin is packed for e-ink controllers: a bit plane per ink (black, then the accent colour on red/yellow panels),
+1 bit per pixel, most significant bit first, rows padded to a whole byte. The size and number of planes are in the
+X-Width, X-Height and X-Planes headers.
+"""
+import argparse
+import collections
+import copy
+import hashlib
+import io
+import logging
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Tuple
+from urllib.parse import parse_qs
+
+from PIL import Image as PILImage
+
+from inkystock.config import Config
+from inkystock.paint import Color, Pillow
+from inkystock.stocks.base import Point, Series
+from inkystock.stocks.relay import PriceCache, Upstream
+from inkystock.trace import tracer
+
+from main import ENV_VARS, setup_logging, provider, render
+
+log = logging.getLogger("inkystock")
+
+FORMATS = {"/frame.png": "image/png", "/frame.bin": "application/octet-stream"}
+COLORS = ['black', 'red', 'yellow']
+# Larger than any Inky, but small enough that nobody can ask for a frame that takes the server down
+MAX_PIXELS = 2000
+
+
+def pack(frame: PILImage.Image, color: str) -> bytes:
+    """
+    A bit plane per ink: black, then the accent colour on red/yellow panels.
+    """
+    indices = PILImage.frombytes('L', frame.size, frame.tobytes())
+    inks = [Color.BLACK] if color == 'black' else [Color.BLACK, Color.ACCENT]
+    planes = []
+    for ink in inks:
+        plane = indices.point([255 if i == ink else 0 for i in range(256)]).convert('1', dither=PILImage.NONE)
+        planes.append(plane.tobytes())
+    return b"".join(planes)
+
+
+def render_frame(config: Config, current: Point, historical: Series, recent: Series, fmt: str) -> bytes:
+    """
+    Runs in a worker process. Fonts and sprites are cached per process, so they're only loaded once per worker.
+    """
+    # The workers live as long as the server, so only the spans for this frame are kept
+    tracer.reset()
+    frame = render(config, Pillow(config), current, historical, recent).render()
+    if fmt == "/frame.bin":
+        return pack(frame, config.main.color)
+    with io.BytesIO() as f:
+        frame.save(f, format="PNG")
+        return f.getvalue()
+
+
+class Renderer:
+    """
+    Renders frames in a pool of worker processes, keeping the most recent ones.
+    """
+
+    def __init__(self, configs: List[Config]):
+        self.configs = {c.main.provider: c for c in configs}
+        self.default = configs[0].main.provider
+        settings = configs[0].render
+        self.prices = PriceCache(configs, provider)
+        self.pool = ProcessPoolExecutor(max_workers=settings.workers or os.cpu_count())
+        self.cache_size = settings.cache_size
+        self._lock = threading.Lock()
+        # Futures rather than frames, so requests for a frame that's already being rendered wait on that render
+        self._frames: "collections.OrderedDict[str, Future[bytes]]" = collections.OrderedDict()
+        self._recent: Dict[Tuple[str, ...], Deque[Point]] = {}
+
+    def __repr__(self):
+        return f"(Renderer providers={list(self.configs)}, frames={len(self._frames)}/{self.cache_size})"
+
+    def config(self, params: Dict[str, str]) -> Config:
+        """
+        The configuration for a request: the provider's own, for a different asset, currency and display.
+        """
+        name = params.get('provider', self.default)
+        if name not in self.configs:
+            raise ValueError(f"No configuration for the {name} provider")
+        crypto, stock = params.get('crypto', ''), params.get('stock', '')
+        if bool(crypto) == bool(stock):
+            raise ValueError("One of *either* stock or crypto must be specified")
+        width, height = int(params.get('width', 250)), int(params.get('height', 122))
+        if not (0 < width <= MAX_PIXELS and 0 < height <= MAX_PIXELS):
+            raise ValueError(f"width and height must be between 1 and {MAX_PIXELS}")
+        color = params.get('color', 'black')
+        if color not in COLORS:
+            raise ValueError(f"color must be one of {COLORS}")
+        currency = params.get('currency', self.configs[name].main.currency).upper()
+
+        config = copy.copy(self.configs[name])
+        config.main = config.main.copy(update={
+            'crypto': crypto, 'stock': stock, 'currency': currency,
+            'display_width_pixels': width, 'display_height_pixels': height, 'color': color,
+        })
+        return config
+
+    def data(self, config: Config) -> Tuple[Point, Series, Series]:
+        asset = (config.main.provider, config.main.crypto, config.main.stock, config.main.currency)
+        current = Point.parse_raw(self.prices.get('current', asset))
+        historical = Series.parse_raw(self.prices.get('historical', asset))
+        with self._lock:
+            recent = self._recent.setdefault(asset, collections.deque(maxlen=10))
+            if not recent or recent[0].timestamp != current.timestamp:
+                recent.appendleft(current)
+            return current, historical, Series(series=list(recent))
+
+    def frame(self, fmt: str, config: Config) -> bytes:
+        current, historical, recent = self.data(config)
+
+        m = hashlib.sha1()
+        for part in (fmt, config.main.json(), current.json(), historical.json(), recent.json()):
+            m.update(part.encode('utf-8'))
+        key = m.hexdigest()
+
+        with self._lock:
+            future = self._frames.get(key)
+            if future is not None:
+                self._frames.move_to_end(key)
+                log.debug(f"Frame cache hit for {key}")
+            else:
+                future = self.pool.submit(render_frame, config, current, historical, recent, fmt)
+                self._frames[key] = future
+                while len(self._frames) > self.cache_size:
+                    self._frames.popitem(last=False)
+        try:
+            return future.result()
+        except Exception:
+            # Not worth keeping a failure around
+            with self._lock:
+                if self._frames.get(key) is future:
+                    del self._frames[key]
+            raise
+
+    def close(self):
+        self.pool.shutdown()
+
+
+def serve(renderer: Renderer, host: str, port: int) -> ThreadingHTTPServer:
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            path, _, query = self.path.partition("?")
+            if path not in FORMATS:
+                self.send_error(404)
+                return
+            params = {k: v[0] for k, v in parse_qs(query).items()}
+            try:
+                config = renderer.config(params)
+                body = renderer.frame(path, config)
+            except ValueError as e:
+                self.send_error(400, str(e))
+                return
+            except Upstream as e:
+                self.send_error(502, str(e))
+                return
+            except Exception as e:
+                log.exception(f"Couldn't render a frame for {self.path}: {e}")
+                self.send_error(500, "Couldn't render the frame")
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", FORMATS[path])
+            self.send_header("Content-Length", str(len(body)))
+            if path == "/frame.bin":
+                self.send_header("X-Width", str(config.main.display_width_pixels))
+                self.send_header("X-Height", str(config.main.display_height_pixels))
+                self.send_header("X-Planes", "1" if config.main.color == 'black' else "2")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, fmt, *args):
+            log.debug(f"Render server: {fmt % args}")
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("configs", nargs="+", help="a config.ini per provider")
+    parser.add_argument("--loglevel", default="INFO")
+    args = parser.parse_args()
+
+    setup_logging(args.loglevel)
+
+    configs = [Config(env_vars=ENV_VARS, path=path, snapshot=True) for path in args.configs]
+    settings = configs[0].render
+    renderer = Renderer(configs)
+    server = serve(renderer, settings.host, settings.port)
+    log.info(f"Serving frames on http://{settings.host}:{server.server_address[1]}/frame.png")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        renderer.close()
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,167 @@
+"""
+Keep the display up to date from a streaming price feed (see [Stream] in config.ini), instead of polling from cron.
+
+The latest price is kept in memory, one price per sample interval is stored (in batches), and the display is only
+redrawn when the price has moved by more than the threshold since the last redraw.
+
+Prices from the feed are stored under the [Main] provider, as if it had been asked for them. They're the same asset in
+the same currency, so the ticker bar, the intraday chart, and main.py runs against the same database all carry on from
+them.
+
+    python stream.py --config config.ini
+    python stream.py --config config.ini --fake    # against a local fake feed, for trying it out
+"""
+import argparse
+import logging
+import signal
+import sys
+import time
+from datetime import date
+from typing import List, Optional
+
+from sqlalchemy import exc
+
+from inkystock.config import Config
+from inkystock.db import Database
+from inkystock.outputs import Outputs
+from inkystock.paint import Pillow
+from inkystock.stocks.base import Point, Series
+from inkystock.stocks.scheduler import Scheduled
+from inkystock.stocks.stream import FakeFeed, LineFeed, Stream
+from inkystock.trace import span, tracer
+
+from main import ENV_VARS, setup_logging, provider, historical_data, chart_data, render
+
+log = logging.getLogger("inkystock")
+
+
+def moved(drawn: Optional[Point], latest: Point, threshold: float) -> bool:
+    """
+    Has the price moved far enough since it was last drawn to be worth a redraw?
+    """
+    if drawn is None:
+        return True
+    if drawn.data == 0:
+        return latest.data != 0
+    return abs(latest.data - drawn.data) / abs(drawn.data) >= threshold
+
+
+class Streamer:
+
+    def __init__(self, config: Config):
+        self.config = config
+        self.db = Database(config)
+        self.painter = Pillow(config)
+        self.outputs = Outputs(config, self.painter)
+        # The daily history for the headline and chart still comes from the provider (cached, once a day)
+        self.stocks = Scheduled(config, self.db, provider(config))
+        self.historical: Optional[Series] = None
+        self.historical_day: Optional[date] = None
+
+        self.latest: Optional[Point] = None
+        self.drawn: Optional[Point] = None
+        self.pending: List[Point] = []
+        self.sampled = 0.0
+        self.flushed = time.monotonic()
+        self.redrawn = 0.0
+
+    def __repr__(self):
+        return f"(Streamer latest={self.latest}, drawn={self.drawn}, pending={len(self.pending)})"
+
+    def tick(self, point: Point):
+        self.latest = point
+        now = time.monotonic()
+        if now - self.sampled >= self.config.stream.sample_interval:
+            self.pending.append(point)
+            self.sampled = now
+
+    def flush(self):
+        self.flushed = time.monotonic()
+        try:
+            self.db.store_many(self.pending)
+        except exc.SQLAlchemyError as e:
+            # e.g., "database is locked" while main.py writes to it from cron: keep them for the next flush
+            log.warning(f"Couldn't store {len(self.pending)} prices, trying again next flush: {e}")
+            return
+        self.pending = []
+
+    def redraw(self, latest: Point):
+        tracer.reset()
+        try:
+            with span("run"):
+                # Make sure the price being drawn is stored, so the ticker bar agrees with the headline
+                if not self.pending or self.pending[-1] is not latest:
+                    self.pending.append(latest)
+                    self.sampled = time.monotonic()
+                self.flush()
+
+                if self.historical is None or self.historical_day != date.today():
+                    self.historical = historical_data(self.db, self.stocks)
+                    self.historical_day = date.today()
+
+                image = render(self.config, self.painter, latest, self.historical, self.db.recent(),
+                               plotted=chart_data(self.config, self.db, self.historical))
+                with span("outputs"):
+                    self.outputs.publish(image)
+        except Exception as e:
+            # The display keeps the last frame, and it's tried again after min_redraw_interval
+            log.exception(f"Redraw failed: {e}")
+            self.redrawn = time.monotonic()
+            return
+
+        self.drawn = latest
+        self.redrawn = time.monotonic()
+        log.info(f"Redrew at {latest.data}; timings: {tracer.summary()}")
+        tracer.export(self.config.metrics.json_path, self.config.metrics.prometheus)
+
+    def run(self, stream: Stream):
+        settings = self.config.stream
+        while True:
+            point = stream.get(timeout=1.0)
+            if point is not None:
+                self.tick(point)
+
+            now = time.monotonic()
+            if self.pending and now - self.flushed >= settings.flush_interval:
+                self.flush()
+            if self.latest is not None and now - self.redrawn >= settings.min_redraw_interval \
+                    and moved(self.drawn, self.latest, settings.threshold):
+                self.redraw(self.latest)
+
+    def close(self):
+        try:
+            self.flush()
+            if self.pending:
+                log.error(f"Couldn't store the last {len(self.pending)} prices before stopping")
+        finally:
+            self.outputs.close(self.config.fetch.timeout)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="config.ini")
+    parser.add_argument("--fake", action="store_true", help="serve a fake feed locally and stream from that")
+    args = parser.parse_args()
+
+    config = Config(env_vars=ENV_VARS, path=args.config, snapshot=True)
+    setup_logging(config.main.loglevel)
+
+    fake = FakeFeed(config) if args.fake else None
+    stream = Stream(LineFeed(config))
+    streamer = Streamer(config)
+
+    # Stopped by systemd (or similar): flush the stored prices on the way out
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        streamer.run(stream)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream.close()
+        streamer.close()
+        if fake is not None:
+            fake.close()
+
+
+if '__main__' == __name__:
+    main()
@@ -1,8 +1,8 @@
 from abc import ABC, abstractmethod
 from datetime import datetime
-from typing import Tuple
+from typing import Optional, Tuple
 
-from inkystock.chart import Chart as ChartBuilder
+from inkystock.chart import Chart as ChartBuilder, ChartMode
 from inkystock.config import Config
 from inkystock.layout import Container, Padding, Align, Display, Border
 from inkystock.paint import Painter
@@ -35,6 +35,12 @@ class UI(ABC):
 
 class StatusBar(UI):
     FORMAT_DATETIME = "%-d/%-m  %H:%M"
+    # Marks a price that couldn't be refreshed, alongside the time it's from
+    FORMAT_STALE = "! %-d/%-m %H:%M"
+
+    def __init__(self, config: Config, painter: Painter, stale: Optional[datetime] = None):
+        super().__init__(config, painter)
+        self.stale = stale
 
     def paint_text(self, text):
         return self.painter.text(text=text,
@@ -67,7 +73,11 @@ class StatusBar(UI):
                                      padding=Padding(right=1),
                                      name="status_bar_right")
 
-        date_text = self.painter.text(text=datetime.now().strftime(self.FORMAT_DATETIME),
+        if self.stale:
+            date = self.stale.strftime(self.FORMAT_STALE)
+        else:
+            date = datetime.now().strftime(self.FORMAT_DATETIME)
+        date_text = self.painter.text(text=date,
                                       font=self.config.fonts.statusbar,
                                       font_size=self.config.fonts.statusbar_size)
         status_bar_right.add(date_text)
@@ -200,13 +210,20 @@ class Chart(UI):
         if limit < 1:
             raise ValueError("limit must be a positive integer")
 
-        self.series = Series(series=series.series[-limit:])
+        if self.config.chart.mode == ChartMode.INTRADAY:
+            # Already limited to the configured window by the database (and downsampled by the chart if need be)
+            self.series = series
+            self.timestamp_format = ChartBuilder.INTRADAY_TIMESTAMP_FORMAT
+        else:
+            self.series = Series(series=series.series[-limit:])
+            self.timestamp_format = ChartBuilder.TIMESTAMP_FORMAT
 
     def build(self) -> Container:
         # Chart
         chart = ChartBuilder(self.config,
                              width=self.config.main.display_width_pixels,
-                             height=int(self.config.main.display_height_pixels / 2))
+                             height=int(self.config.main.display_height_pixels / 2),
+                             timestamp_format=self.timestamp_format)
         chart.plot(self.series)
 
         chart_box = Container(chart.width(),